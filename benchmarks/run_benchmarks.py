@@ -0,0 +1,175 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+
+from benchmarks.tile_server import TileServer
+
+# --------------------------------------------------------------------
+# stage-level benchmarks of the poster pipeline
+# - tiles are served by a local tile server (generated tiles, configurable latency)
+# - stages of the pipeline (as run by posterize.py) are timed for a matrix of locations, zoom levels and dpis
+# - every case runs in its own process (peak rss per case) with its own tile cache
+# - results are written as json, a previous result file can be given for comparison
+#
+# usage (from the repository root):
+#   python -m benchmarks.run_benchmarks -z 13 15 -d 100 300 --latency 0.02 -o results.json
+#   python -m benchmarks.run_benchmarks -o results_new.json --compare results.json
+
+stages = ("download_tiles", "draw", "stylize", "draw_marker", "crop_to_coords", "get_scaled", "draw_text_box", "save")
+
+def _run_case(case, tile_url, tiles_folder, warm_up):
+    # run all pipeline stages of a case (in a separate process), returns result dict
+    from map_posterizer.canvas import Canvas, CanvasStyle
+    from map_posterizer.map import Map, MapLocation, MapStyle, MapTileProvider
+    from map_posterizer.metrics import get_peak_rss_mb
+    from map_posterizer.places import configure_place_lookup
+
+    with open(case["location"], "r") as f:
+        location = MapLocation(json.load(f))
+    with open(case["canvas_style"], "r") as f:
+        canvas_style = CanvasStyle(json.load(f))
+    with open(case["map_style"], "r") as f:
+        map_style = MapStyle(json.load(f))
+    configure_place_lookup(cache_file=None, online=False)
+
+    timings = {}
+    provider = MapTileProvider({"name": "benchmark", "url": tile_url}, tiles_folder, True, case["workers"])
+    canvas = Canvas(canvas_style, case["dpi"])
+    map = Map(map_style, canvas.content_size_mm, case["dpi"], location.top_left, location.bottom_right, case["zoom"],
+              case["workers"], provider)
+    if warm_up:
+        # fill tile cache before measuring
+        map.download_tiles()
+
+    def run_stage(name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    start = time.perf_counter()
+    failed_tiles = run_stage("download_tiles", map.download_tiles)
+    run_stage("draw", map.draw, True)
+    run_stage("stylize", map.stylize)
+    run_stage("draw_marker", map.draw_marker, location.marker)
+    run_stage("crop_to_coords", map.crop_to_coords)
+    image_scaled = run_stage("get_scaled", map.get_scaled)
+    canvas.draw_map(image_scaled)
+    run_stage("draw_text_box", canvas.draw_text_box, location.caption1, location.caption2, location.caption3, location.caption4,
+              location.get_marker_coords())
+    run_stage("save", canvas.save, os.path.join(tiles_folder, "poster.png"), False)
+    total = time.perf_counter() - start
+
+    result = dict(case)
+    result.update({
+        "num_tiles": map.num_tiles[0] * map.num_tiles[1],
+        "num_failed_tiles": len(failed_tiles),
+        "raw_size_px": list(map.raw_size_px),
+        "size_px": list(map.size_px),
+        "stages": timings,
+        "total": total,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "tile_stats": provider.get_stats(),
+    })
+    return result
+
+def create_cases(args):
+    cases = []
+    for location in args.locations:
+        for zoom in args.zooms:
+            for dpi in args.dpis:
+                for cache in args.cache:
+                    cases.append({
+                        "location": location,
+                        "name": os.path.splitext(os.path.basename(location))[0],
+                        "zoom": zoom,
+                        "dpi": dpi,
+                        "cache": cache,
+                        "map_style": args.map_style,
+                        "canvas_style": args.canvas_style,
+                        "workers": args.workers,
+                    })
+    return cases
+
+def run_benchmarks(args):
+    server = TileServer(latency=args.latency).start()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for i, case in enumerate(create_cases(args)):
+            print("case " + str(i + 1) + ": " + case["name"] + ", zoom " + str(case["zoom"]) + ", " + str(case["dpi"]) + " dpi, " +
+                  case["cache"] + " cache ... ", end="", flush=True)
+            with tempfile.TemporaryDirectory() as tiles_folder:
+                # fresh process per case (peak rss of this case only)
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_run_case, case, server.get_url(), tiles_folder, case["cache"] == "warm").result()
+            results.append(result)
+            print(str(result["num_tiles"]) + " tiles, " + str(round(result["total"], 2)) + " s, " +
+                  str(round(result["peak_rss_mb"] or 0.0, 1)) + " MB")
+    finally:
+        server.stop()
+    return results
+
+def _get_case_key(result):
+    return (result["name"], result["zoom"], result["dpi"], result["cache"])
+
+def compare_results(results, baseline):
+    # print relative timings of all cases that are in both result sets
+    baseline_results = {_get_case_key(result): result for result in baseline["results"]}
+    print("comparison with baseline (time ratio new / baseline):")
+    for result in results:
+        previous = baseline_results.get(_get_case_key(result))
+        if previous is None:
+            continue
+        ratios = []
+        for stage in stages + ("total",):
+            new_time = result["total"] if stage == "total" else result["stages"].get(stage)
+            old_time = previous["total"] if stage == "total" else previous["stages"].get(stage)
+            if new_time is not None and old_time:
+                ratios.append(stage + " " + str(round(new_time / old_time, 2)))
+        print("   " + " / ".join(str(value) for value in _get_case_key(result)) + ": " + ", ".join(ratios))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MapPosterizer benchmarks')
+    parser.add_argument("-l", "--locations", type=str, nargs="+", help="location json files",
+                        default=sorted(glob.glob("resources/examples/*.json")))
+    parser.add_argument("-z", "--zooms", type=int, nargs="+", help="zoom levels", default=[13, 15])
+    parser.add_argument("-d", "--dpis", type=int, nargs="+", help="dpis", default=[100, 300])
+    parser.add_argument("--cache", type=str, nargs="+", choices=("cold", "warm"), help="tile cache state", default=["cold"])
+    parser.add_argument("-m", "--map_style", type=str, help="map style json file", default="resources/map_style_light.json")
+    parser.add_argument("-c", "--canvas_style", type=str, help="canvas style json file", default="resources/canvas_style_dark.json")
+    parser.add_argument("-w", "--workers", type=int, help="number of tile download workers", default=8)
+    parser.add_argument("--latency", type=float, help="latency of tile server responses (s)", default=0.0)
+    parser.add_argument("-o", "--output", type=str, help="output json file", default="benchmark_results.json")
+    parser.add_argument("--compare", type=str, help="json file of a previous run to compare with", default=None)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    start = time.time()
+    results = run_benchmarks(args)
+    output = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "latency": args.latency,
+        "stages": list(stages),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    print(str(len(results)) + " cases in " + str(round(time.time() - start, 1)) + " s, results saved to " + args.output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare_results(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import threading
+import time
+
+from PIL import Image, ImageDraw
+
+# --------------------------------------------------------------------
+# local tile server for benchmarks
+# - serves generated grayscale png tiles (streets-like lines, deterministic per tile) at /{zoom}/{x}/{y}.png
+# - each response is delayed by a configurable latency to emulate a remote tile server
+# - tiles are sent with an ETag, conditional requests are answered with 304
+
+def create_tile(zoom, tile_x, tile_y, tile_size=256):
+    # white tile with a few dark lines (pattern depends on tile location)
+    image = Image.new("L", (tile_size, tile_size), 255)
+    draw = ImageDraw.Draw(image)
+    seed = (tile_x * 73856093) ^ (tile_y * 19349663) ^ (zoom * 83492791)
+    for i in range(4):
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        offset = seed % tile_size
+        width = 2 + (seed >> 8) % 6
+        if i % 2 == 0:
+            draw.line((0, offset, tile_size - 1, (offset + (seed >> 4) % 64) % tile_size), fill=0, width=width)
+        else:
+            draw.line((offset, 0, (offset + (seed >> 4) % 64) % tile_size, tile_size - 1), fill=0, width=width)
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Tile request handler"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        try:
+            parts = self.path.strip("/").split("/")
+            zoom, tile_x, tile_y = int(parts[-3]), int(parts[-2]), int(parts[-1].split(".")[0])
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+        if server.latency > 0.0:
+            time.sleep(server.latency)
+        with server.lock:
+            server.num_requests += 1
+
+        etag = "\"" + str(zoom) + "-" + str(tile_x) + "-" + str(tile_y) + "\""
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = create_tile(zoom, tile_x, tile_y)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer:
+    """Local tile server (runs in a background thread)"""
+
+    def __init__(self, port=0, latency=0.0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), TileRequestHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.num_requests = 0
+        self.server.lock = threading.Lock()
+        self.thread = None
+
+    def get_url(self):
+        # url template as used by MapTileProvider ({0}: zoom, {1}: x, {2}: y)
+        return "http://127.0.0.1:" + str(self.server.server_address[1]) + "/{0}/{1}/{2}.png"
+
+    def get_num_requests(self):
+        return self.server.num_requests
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import io
+import json
+import logging
+import multiprocessing
+import time
+
+from map_posterizer.map import MapStyle, MapTileProvider
+from map_posterizer.metrics import Metrics
+from map_posterizer.planner import check_budgets
+from map_posterizer.poster import PosterError, PosterJob, create_poster, create_tile_provider, render_poster
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# batch rendering
+# - a manifest lists poster jobs (location, map style, canvas style, dpi, output, ...)
+# - jobs exceeding their budgets are rejected before any tiles are fetched
+# - tiles needed by all jobs are fetched once (union of all tile sets)
+# - posters are rendered in a pool of worker processes
+
+def load_manifest(filename, defaults):
+    # load poster jobs from manifest ({"jobs": [...]} or plain list), missing values are taken from defaults
+    with open(filename, "r") as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get("jobs", [])
+    jobs = []
+    for config in manifest:
+        job_config = dict(defaults)
+        job_config.update(config)
+        jobs.append(PosterJob(job_config))
+    return jobs
+
+def _render_job(job):
+    # render a single job in a worker process, log output of the pipeline is captured
+    start = time.time()
+    log = io.StringIO()
+    handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    package_logger = logging.getLogger("map_posterizer")
+    package_logger.addHandler(handler)
+    package_logger.setLevel(logging.INFO)
+    metrics = Metrics()
+    result = {"output": job.output, "ok": False, "error": None}
+    try:
+        render_poster(job, metrics=metrics)
+        result["ok"] = True
+    except PosterError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+    finally:
+        package_logger.removeHandler(handler)
+    result["time"] = time.time() - start
+    result["log"] = log.getvalue()
+    result["metrics"] = metrics.get_report()
+    return result
+
+def _get_provider_key(job):
+    # jobs share a tile provider if they use the same tile archive or the same provider of their map style
+    if job.tiles is not None:
+        return ("archive", job.tiles)
+    try:
+        with open(job.map_style, "r") as f:
+            return ("style", MapStyle(json.load(f)).style)
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid style files! (" + str(e) + ")", 3)
+
+def fetch_batch_tiles(jobs, num_workers):
+    # fetch union of tiles of all jobs once, returns dict job index -> error
+    errors = {}
+    providers = {}
+    tile_sets = {}
+    job_tiles = {}
+    for i, job in enumerate(jobs):
+        try:
+            job.validate()
+            key = _get_provider_key(job)
+            if key not in providers:
+                if key[0] == "archive":
+                    providers[key] = create_tile_provider(job)
+                else:
+                    providers[key] = MapTileProvider(key[1], "cache/", True, num_workers)
+            check_budgets(job, providers[key])
+            location, canvas, map = create_poster(job, providers[key], verbose=False)
+        except PosterError as e:
+            errors[i] = str(e)
+            continue
+        tiles = map.get_tiles()
+        tile_sets.setdefault((key, map.zoom), set()).update(tiles)
+        job_tiles[i] = (key, map.zoom, tiles)
+
+    num_tiles = sum(len(tiles) for tiles in tile_sets.values())
+    num_job_tiles = sum(len(tiles[2]) for tiles in job_tiles.values())
+    logger.info("fetching " + str(num_tiles) + " tiles for " + str(len(jobs)) + " jobs (" + str(num_job_tiles) + " tiles without sharing) ...")
+    failed = {}
+    for (key, zoom), tiles in tile_sets.items():
+        failed[(key, zoom)] = set(providers[key].fetch_tiles(zoom, sorted(tiles)))
+
+    # jobs with missing tiles fail
+    for i, (key, zoom, tiles) in job_tiles.items():
+        num_failed = len(failed[(key, zoom)].intersection(tiles))
+        if num_failed > 0:
+            errors[i] = "failed to download " + str(num_failed) + " map tiles!"
+    return errors
+
+def render_batch(jobs, num_processes, num_workers=8):
+    # render all jobs, returns list of per-job results
+    start = time.time()
+    results = [None] * len(jobs)
+    errors = fetch_batch_tiles(jobs, num_workers)
+    for i, error in errors.items():
+        results[i] = {"output": jobs[i].output, "ok": False, "error": error, "time": 0.0, "log": "", "metrics": None}
+
+    # render jobs in worker processes (spawned, workers must not share tile cache connections)
+    pending = [i for i in range(len(jobs)) if results[i] is None]
+    logger.info("rendering " + str(len(pending)) + " posters with " + str(num_processes) + " processes ...")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=context) as executor:
+        futures = {executor.submit(_render_job, jobs[i]): i for i in pending}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # crashed worker process (e.g. BrokenProcessPool) or job that can't be passed to a worker
+                result = {"output": jobs[i].output, "ok": False, "error": type(e).__name__ + ": " + str(e), "time": 0.0,
+                          "log": "", "metrics": None}
+            results[i] = result
+            status = "ok" if result["ok"] else "failed: " + result["error"]
+            logger.info("   job " + str(i + 1) + " of " + str(len(jobs)) + ": " + result["output"] + " " + status +
+                        " (" + str(round(result["time"], 1)) + " s)")
+
+    num_ok = sum(1 for result in results if result["ok"])
+    logger.info(str(num_ok) + " of " + str(len(jobs)) + " posters rendered in " + str(round(time.time() - start, 1)) + " s")
+    for i, result in enumerate(results):
+        if not result["ok"]:
+            logger.warning("   failed: job " + str(i + 1) + " (" + result["output"] + "): " + result["error"])
+    return results
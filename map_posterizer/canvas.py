@@ -1,8 +1,10 @@
 import os
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 
 from map_posterizer.drawing_utils import *
+from map_posterizer.encoders import save_image
 from map_posterizer.geo_utils import *
+from map_posterizer.places import lookup_place
 
 
 class CanvasStyle:
@@ -45,6 +47,10 @@ class CanvasStyle:
         if "text_box_font" in config:
             self.text_box_font = config["text_box_font"]
 
+    def get_content_size_mm(self):
+        # size of map area (canvas without borders)
+        return (self.size_mm[0] - 2 * self.border_mm[0], self.size_mm[1] - 2 * self.border_mm[1])
+
 
 class Canvas:
     """Canvas class"""
@@ -53,7 +59,7 @@ class Canvas:
         self.style = style
         self.size_mm = style.size_mm
         self.border_mm = style.border_mm
-        self.content_size_mm = (style.size_mm[0] - 2 * style.border_mm[0], style.size_mm[1] - 2 * style.border_mm[1])
+        self.content_size_mm = style.get_content_size_mm()
         self.dpi = dpi
 
         # calculate pixel dimensions
@@ -75,6 +81,20 @@ class Canvas:
         self.map_size_px = map.size
         self.image.paste(map, self.border_px)
 
+    def get_map(self):
+        # map region of canvas (as drawn by draw_map or draw_map_bands)
+        return self.image.crop((self.border_px[0], self.border_px[1],
+                                self.border_px[0] + self.map_size_px[0], self.border_px[1] + self.map_size_px[1]))
+
+    def draw_map_layer(self, layer):
+        # blend rgba layer (of map size) onto map
+        self.image.paste(layer.convert("RGB"), self.border_px, layer)
+
+    def draw_map_bands(self, map, marker, band_rows, overlay=None):
+        # render map band-wise directly onto canvas
+        self.map_size_px = map.size_px
+        map.render_bands(self.image, self.border_px, marker, band_rows, overlay)
+
     def draw_text_box(self, caption1, caption2, caption3, caption4, coords):
         # draw captions below map
         image_caption1 = caption1
@@ -82,7 +102,7 @@ class Canvas:
 
         image_caption3 = caption3
         if image_caption3 == "<location>":
-            image_caption3 = geoCoordinatesToPlace(coords)
+            image_caption3 = lookup_place(coords)
         
         image_caption4 = caption4
         if coords is None:
@@ -98,19 +118,19 @@ class Canvas:
         
         # font sizes for captions
         font_size = int(72 / 150 * self.dpi)
-        cap1_font = ImageFont.truetype(self.style.text_box_font, font_size)
+        cap1_font = load_font(self.style.text_box_font, font_size)
         cap1_color = self.style.foreground
 
         font_size2 = int(font_size * 0.80)
-        cap2_font = ImageFont.truetype(self.style.text_box_font, font_size2)
+        cap2_font = load_font(self.style.text_box_font, font_size2)
         cap2_color = self.style.foreground
 
         font_size3 = int(font_size * 0.70)
-        cap3_font = ImageFont.truetype(self.style.text_box_font, font_size3)
+        cap3_font = load_font(self.style.text_box_font, font_size3)
         cap3_color = self.style.foreground
 
         font_size4 = int(font_size * 0.50)
-        cap4_font = ImageFont.truetype(self.style.text_box_font, font_size4)
+        cap4_font = load_font(self.style.text_box_font, font_size4)
         cap4_color = cap3_color
 
         # compute caption print sizes
@@ -175,8 +195,9 @@ class Canvas:
         pos_x = self.center_px[0] - text_w4 / 2
         draw.text((pos_x, box_y + pos_y4), image_caption4, font=cap4_font, fill=cap4_color, align="center")
 
-    def save(self, filename, show):
-        self.image.save(filename, 'PNG')
+    def save(self, filename, show, output_format=None, compress_level=6, quality=90, fast=False):
+        # output format from file extension unless given (png, tiff, jpeg, webp or pdf)
+        save_image(self.image, filename, output_format, compress_level, quality, fast, self.dpi)
         if show:
             self.image.show()
 
@@ -1,6 +1,10 @@
-from PIL import Image, ImageDraw, ImageOps
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
+import functools
+import hashlib
 import io
+import os
+import tempfile
 import cairosvg
 
 # --------------------------------------------------------------------
@@ -35,15 +39,67 @@ def load_svg(filename):
    return Image.open(mem)
 
 def draw_heart_svg(image, pos, width_px, opacity=1.0):
-    # load heart icon from svg
-    image_heart = load_svg("resources/pin-heart.svg")
-    image_heart_ratio = image_heart.size[1] / image_heart.size[0]
-    size_heart = (width_px, int(width_px * image_heart_ratio))
-    # resize image
-    image_heart = image_heart.resize(size_heart, resample=Image.BICUBIC)
-    # scale alpha value
-    r, g, b, alpha = image_heart.split()
-    alpha = alpha.point(lambda i: i * opacity)
+    # load heart icon (rasterized from svg, alpha already scaled)
+    image_heart = load_marker_sprite("resources/pin-heart.svg", width_px, opacity)
+    size_heart = image_heart.size
     # paste heart into image
     pos_int = (int(pos[0]) - int(size_heart[0] / 2), int(pos[1]) - size_heart[1])
-    image.paste(image_heart, pos_int, alpha)
+    image.paste(image_heart, pos_int, image_heart)
+
+# --------------------------------------------------------------------
+# asset cache
+# - fonts and rasterized marker sprites are kept for all renders of a process
+# - sprites are optionally also stored on disk (see configure_asset_cache)
+
+_asset_cache_folder = None
+
+def configure_asset_cache(folder):
+    # folder for rasterized sprites (None: memory only)
+    global _asset_cache_folder
+    _asset_cache_folder = folder
+
+@functools.lru_cache(maxsize=64)
+def load_font(font, size):
+    return ImageFont.truetype(font, size)
+
+def _rasterize_sprite(filename, width_px, opacity):
+    # load icon from svg
+    image_sprite = load_svg(filename).convert("RGBA")
+    sprite_ratio = image_sprite.size[1] / image_sprite.size[0]
+    size_sprite = (width_px, int(width_px * sprite_ratio))
+    # resize image
+    image_sprite = image_sprite.resize(size_sprite, resample=Image.BICUBIC)
+    # scale alpha value
+    r, g, b, alpha = image_sprite.split()
+    alpha = alpha.point([int(i * opacity) for i in range(256)])
+    image_sprite.putalpha(alpha)
+    return image_sprite
+
+@functools.lru_cache(maxsize=64)
+def load_marker_sprite(filename, width_px, opacity):
+    # rasterized sprite with applied opacity, cached in memory and optionally on disk
+    folder = _asset_cache_folder
+    if folder is None:
+        return _rasterize_sprite(filename, width_px, opacity)
+
+    # sprites on disk are keyed by svg content, so changed svg files are rasterized again
+    with open(filename, "rb") as f:
+        key = hashlib.sha1(f.read() + ("/" + str(width_px) + "/" + str(opacity)).encode("utf-8")).hexdigest()
+    sprite_file = os.path.join(folder, "sprite_" + key + ".png")
+    if os.path.isfile(sprite_file):
+        image_sprite = Image.open(sprite_file)
+        image_sprite.load()
+        return image_sprite
+    image_sprite = _rasterize_sprite(filename, width_px, opacity)
+    os.makedirs(folder, exist_ok=True)
+    # unique temp file per writer (render threads of a process may store the same sprite at the same time)
+    fd, temp_file = tempfile.mkstemp(prefix="sprite_", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            image_sprite.save(f, "PNG")
+        os.replace(temp_file, sprite_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return image_sprite
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# --------------------------------------------------------------------
+# output encoders
+# - png: rows are filtered and deflated in chunks by a pool of threads (zlib releases the gil), each chunk
+#   is primed with the last 32 kb of the previous chunk and ends on a byte boundary (sync flush), so the
+#   chunks form one zlib stream (checksum: adler32 of chunks combined)
+# - tiff (deflate/packbits strips), jpeg, webp and pdf are written by PIL (webp has no resolution field,
+#   the dpi is stored in exif tags)
+# useful literature
+# - png format: https://www.w3.org/TR/png/
+# - parallel deflate as in pigz: https://zlib.net/pigz/
+
+output_formats = {
+    ".png": "png",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".webp": "webp",
+    ".pdf": "pdf",
+}
+
+def get_output_format(filename):
+    # output format from file extension (png for unknown extensions)
+    return output_formats.get(os.path.splitext(filename)[1].lower(), "png")
+
+def _adler32_combine(adler1, adler2, length2):
+    # adler32 of concatenated data from adler32 of both parts (as adler32_combine in zlib)
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - remainder
+    sum1 = sum1 % base
+    sum2 = sum2 % base
+    return sum1 | (sum2 << 16)
+
+def _png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+def _filter_rows(rows):
+    # png filter "up" for all rows but the first one of rows (difference to row above), with filter type byte
+    filtered = rows[1:].copy()
+    filtered -= rows[:-1]
+    filter_type = np.full((filtered.shape[0], 1), 2, dtype=np.uint8)
+    return np.concatenate((filter_type, filtered.reshape(filtered.shape[0], -1)), axis=1)
+
+class ParallelPngEncoder:
+    """Parallel PNG encoder"""
+
+    # rows per chunk, size of deflate window (dictionary of following chunk)
+    chunk_rows = 256
+    window_size = 32768
+
+    def __init__(self, compress_level=6, num_workers=None):
+        self.compress_level = compress_level
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+
+    def _encode_chunk(self, image, y0, y1, last):
+        # filtered and deflated rows y0..y1, returns (compressed data, adler32 and length of filtered data)
+        width = image.size[0]
+        bands = len(image.getbands())
+        row_bytes = width * bands + 1
+        # rows of the previous chunk needed for the dictionary (plus one row above for filtering)
+        num_dict_rows = 0 if y0 == 0 else min(y0, -(-ParallelPngEncoder.window_size // row_bytes))
+        crop_y0 = y0 - num_dict_rows - 1
+        data = image.crop((0, max(crop_y0, 0), width, y1)).tobytes()
+        rows = np.frombuffer(data, dtype=np.uint8).reshape(-1, width * bands)
+        if crop_y0 < 0:
+            # first row of image: "up" filter with a row of zeros above
+            rows = np.concatenate((np.zeros((1, width * bands), dtype=np.uint8), rows))
+        filtered = _filter_rows(rows).tobytes()
+        dictionary = filtered[max(0, num_dict_rows * row_bytes - ParallelPngEncoder.window_size):num_dict_rows * row_bytes]
+        filtered = filtered[num_dict_rows * row_bytes:]
+
+        if dictionary:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(filtered) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return (_png_chunk(b"IDAT", compressed), zlib.adler32(filtered), len(filtered))
+
+    def save(self, image, filename, dpi=None):
+        color_types = {"L": 0, "RGB": 2, "RGBA": 6}
+        if image.mode not in color_types:
+            image = image.convert("RGB")
+        width, height = image.size
+        image.load()
+
+        with open(filename, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_types[image.mode], 0, 0, 0)))
+            if dpi is not None:
+                pixels_per_meter = int(round(dpi / 0.0254))
+                f.write(_png_chunk(b"pHYs", struct.pack(">IIB", pixels_per_meter, pixels_per_meter, 1)))
+            # zlib header (deflate, 32k window, default compression)
+            f.write(_png_chunk(b"IDAT", b"\x78\x9c"))
+
+            # chunks are encoded in parallel and written in order (number of chunks in memory is bounded)
+            ranges = [(y, min(y + ParallelPngEncoder.chunk_rows, height)) for y in range(0, height, ParallelPngEncoder.chunk_rows)]
+            adler = 1
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                futures = []
+                for i, (y0, y1) in enumerate(ranges):
+                    futures.append(executor.submit(self._encode_chunk, image, y0, y1, i + 1 == len(ranges)))
+                    # write finished chunks in order (all of them after the last chunk has been submitted)
+                    while futures and (len(futures) >= 2 * self.num_workers or i + 1 == len(ranges)):
+                        chunk, chunk_adler, chunk_length = futures.pop(0).result()
+                        f.write(chunk)
+                        adler = _adler32_combine(adler, chunk_adler, chunk_length)
+            f.write(_png_chunk(b"IDAT", struct.pack(">I", adler)))
+            f.write(_png_chunk(b"IEND", b""))
+
+
+def _get_dpi_exif(dpi):
+    # exif block with resolution tags (XResolution, YResolution, ResolutionUnit: inch)
+    exif = Image.Exif()
+    exif[0x011A] = float(dpi)
+    exif[0x011B] = float(dpi)
+    exif[0x0128] = 2
+    return exif.tobytes()
+
+def save_image(image, filename, output_format=None, compress_level=6, quality=90, fast=False, dpi=None, num_workers=None):
+    # save image in output format (from file extension if not given), fast: lower compression
+    if output_format is None:
+        output_format = get_output_format(filename)
+    options = {"dpi": (dpi, dpi)} if dpi is not None else {}
+    if output_format == "png":
+        ParallelPngEncoder(1 if fast else compress_level, num_workers).save(image, filename, dpi)
+    elif output_format == "tiff":
+        image.save(filename, "TIFF", compression="packbits" if fast else "tiff_adobe_deflate", **options)
+    elif output_format == "jpeg":
+        image.save(filename, "JPEG", quality=quality, optimize=not fast, **options)
+    elif output_format == "webp":
+        if max(image.size) > 16383:
+            raise ValueError("image too large for webp (max. 16383 px)")
+        webp_options = {"exif": _get_dpi_exif(dpi)} if dpi is not None else {}
+        image.save(filename, "WEBP", quality=quality, method=0 if fast else 4, **webp_options)
+    elif output_format == "pdf":
+        # page size from resolution, image is embedded as jpeg
+        image.save(filename, "PDF", resolution=float(dpi) if dpi is not None else 72.0, quality=quality)
+    else:
+        raise ValueError("unsupported output format: " + str(output_format))
@@ -1,5 +1,7 @@
+import functools
 import math
 
+import numpy as np
 from geopy.geocoders import Nominatim
 
 # --------------------------------------------------------------------
@@ -36,6 +38,14 @@ def degToXY(lat, lon, zoom):
     y = C * (math.pi - math.log(math.tan((math.pi / 4) + math.radians(lat) / 2)))
     return (x, y)
 
+# vectorized conversions for many coordinates at once (arrays of lat/lon values)
+
+def degToXYArray(lat, lon, zoom):
+    C = (256 / (2 * math.pi)) * 2 ** zoom
+    x = C * (np.radians(lon) + math.pi)
+    y = C * (math.pi - np.log(np.tan((math.pi / 4) + np.radians(lat) / 2)))
+    return (x, y)
+
 def degToDMS(deg):
     d = int(deg)
     md = abs(deg - d) * 60
@@ -53,12 +63,16 @@ def degToDMSformatted(lat_f, lon_f):
 # --------------------------------------------------------------------
 # location lookups
 
+@functools.lru_cache(maxsize=1)
+def getGeolocator():
+    return Nominatim(user_agent="MapPosterizer")
+
 def geoCoordinatesToPlace(coords):
     # get location name for coordinates (geopy/Nominatim)
-    geolocator = Nominatim(user_agent="MapPosterizer")
+    geolocator = getGeolocator()
     location = geolocator.reverse(coords)
     place = ""
-    if "address" in location.raw:
+    if location is not None and "address" in location.raw:
         if "city" in location.raw["address"]:
             place = location.raw["address"]["city"]
         if "village" in location.raw["address"]:
@@ -0,0 +1,110 @@
+import itertools
+import os
+
+import numpy as np
+from PIL import Image
+
+from map_posterizer.drawing_utils import mm_to_pixels
+
+# --------------------------------------------------------------------
+# point density heatmap
+# - points are read from a csv file (header with lat/latitude and lon/lng/longitude columns) in chunks
+# - each chunk is projected at once and binned into a density grid of the output map size,
+#   memory usage is independent of the number of points
+# - the grid is blurred (3 box blur passes, close to a gaussian blur) and mapped to colors and opacity
+
+def _find_columns(header):
+    names = [name.strip().strip("\"").lower() for name in header.split(",")]
+    lat_col = None
+    lon_col = None
+    for i, name in enumerate(names):
+        if name in ("lat", "latitude"):
+            lat_col = i
+        elif name in ("lon", "lng", "longitude"):
+            lon_col = i
+    return (lat_col, lon_col)
+
+def _box_blur(grid, radius):
+    # moving average over 2 * radius + 1 rows (zero padded), along first axis
+    padded = np.pad(grid, ((radius + 1, radius), (0, 0)))
+    sums = np.cumsum(padded, axis=0, dtype=np.float64)
+    return ((sums[2 * radius + 1:] - sums[:-2 * radius - 1]) / (2 * radius + 1)).astype(np.float32)
+
+def _create_color_table(colors, opacity):
+    # rgb and alpha values for 256 density levels (colors are interpolated, alpha grows with density)
+    levels = np.linspace(0.0, 1.0, 256)
+    stops = np.linspace(0.0, 1.0, len(colors))
+    colors = np.array(colors, dtype=np.float64)
+    rgb = np.column_stack([np.interp(levels, stops, colors[:, c]) for c in range(3)])
+    alpha = np.minimum(1.0, levels * 2.0) * opacity * 255.0
+    return (np.round(rgb).astype(np.uint8), np.round(alpha).astype(np.uint8))
+
+
+class Heatmap:
+    """Point density heatmap"""
+
+    # number of points read and binned at once
+    chunk_size = 250000
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "r") as f:
+            self.columns = _find_columns(f.readline())
+        if self.columns[0] is None or self.columns[1] is None:
+            raise ValueError("no lat/lon columns in heatmap file " + filename)
+        self.num_points = 0
+        self.num_points_on_map = 0
+
+    def read_points(self):
+        # chunks of lat/lon points
+        with open(self.filename, "r") as f:
+            f.readline()
+            while True:
+                lines = list(itertools.islice(f, Heatmap.chunk_size))
+                if not lines:
+                    return
+                points = np.loadtxt(lines, delimiter=",", usecols=self.columns, dtype=np.float64, ndmin=2)
+                if len(points) > 0:
+                    yield points
+
+    def create_grid(self, map):
+        # number of points per output pixel of map
+        width, height = map.size_px
+        grid = np.zeros(width * height, dtype=np.float32)
+        self.num_points = 0
+        self.num_points_on_map = 0
+        for points in self.read_points():
+            x, y = map.project_to_output(points[:, 0], points[:, 1])
+            x = np.floor(x).astype(np.int64)
+            y = np.floor(y).astype(np.int64)
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            # accumulate counts of distinct pixels (no temporary grid per chunk)
+            pixels, counts = np.unique(y[inside] * width + x[inside], return_counts=True)
+            grid[pixels] += counts
+            self.num_points += len(points)
+            self.num_points_on_map += int(counts.sum())
+        return grid.reshape((height, width))
+
+    def render(self, map):
+        # rgba heatmap image of the output map size
+        style = map.style
+        grid = self.create_grid(map)
+        radius = max(1, int(round(mm_to_pixels(style.heatmap_radius_mm, map.dpi) / 3.0)))
+        for i in range(3):
+            grid = _box_blur(grid, radius)
+            grid = _box_blur(grid.T, radius).T
+        # logarithmic density scale (point sets are usually dominated by a few hot spots)
+        grid = np.log1p(grid)
+        max_value = grid.max()
+        if max_value > 0.0:
+            grid *= 255.0 / max_value
+        levels = grid.astype(np.uint8)
+        rgb, alpha = _create_color_table(style.heatmap_colors, style.heatmap_opacity)
+        image = Image.fromarray(rgb[levels])
+        image.putalpha(Image.fromarray(alpha[levels]))
+        return image
+
+    def __str__(self):
+        output = str(__class__.__name__) + ":"
+        output += os.linesep + "   points: " + str(self.num_points) + " (" + str(self.num_points_on_map) + " on map)"
+        return output
@@ -1,16 +1,33 @@
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import functools
+import hashlib
 from io import BytesIO
+import json
+import logging
 import os
 import threading
+import time
 
-from PIL import Image, ImageOps
-import urllib.request
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+import urllib3
 
 from map_posterizer.drawing_utils import *
 from map_posterizer.geo_utils import *
+from map_posterizer.overlay import clip_polyline
+from map_posterizer.tile_cache import MemoryTileCache, TileCache, get_content_hash
+from map_posterizer.tile_hosts import TileHostPool
+from map_posterizer.tile_sources import open_tile_archive
+
+logger = logging.getLogger(__name__)
 
 class MapLocation:
     """Map location"""
 
+    # valid zoom levels (or "auto")
+    min_zoom = 13
+    max_zoom = 18
+
     def __init__(self):
         self.load([])
 
@@ -24,8 +41,12 @@ class MapLocation:
         self.top_left = None
         self.bottom_right = None
         self.zoom = None
+        self.zoom_bias = 0.0
         self.marker = None
         self.hide_marker = False
+        self.tracks = []
+        self.markers = []
+        self.heatmap = None
         self.caption1 = "H O M E"
         self.caption2 = ""
         self.caption3 = "<location>"
@@ -43,10 +64,21 @@ class MapLocation:
                 self.marker = config["location"]["marker"]
             if "hide_marker" in config["location"]: 
                 self.hide_marker = config["location"]["hide_marker"]
+        if "overlay" in config:
+            if "tracks" in config["overlay"]:
+                self.tracks = config["overlay"]["tracks"]
+            if "markers" in config["overlay"]:
+                self.markers = config["overlay"]["markers"]
+            if "heatmap" in config["overlay"]:
+                self.heatmap = config["overlay"]["heatmap"]
         if "zoom" in config:
             self.zoom = config["zoom"]
-            if self.zoom < 13 or self.zoom > 18:
+            if self.zoom == "auto":
+                pass
+            elif not isinstance(self.zoom, int) or self.zoom < MapLocation.min_zoom or self.zoom > MapLocation.max_zoom:
                 self.zoom = None
+        if "zoom_bias" in config:
+            self.zoom_bias = float(config["zoom_bias"])
         if "caption" in config:
             if "caption1" in config["caption"]: 
                 self.caption1 = config["caption"]["caption1"]
@@ -72,9 +104,54 @@ class MapLocation:
         output += os.linesep + "   coords bottom-right: " + str(self.bottom_right)
         if self.marker:
             output += os.linesep + "   coords marker: " + str(self.marker)
+        if self.tracks or self.markers:
+            output += os.linesep + "   overlay: " + str(len(self.tracks)) + " track files, " + str(len(self.markers)) + " markers"
+        if self.heatmap:
+            output += os.linesep + "   heatmap: " + str(self.heatmap)
         output += os.linesep + "   zoom level: " + str(self.zoom)
+        if self.zoom == "auto" and self.zoom_bias != 0.0:
+            output += os.linesep + "   zoom bias: " + str(self.zoom_bias)
         return output
 
+# --------------------------------------------------------------------
+# map style lookup tables
+# - contrast boost (per channel), conversion to grayscale and colorization are combined
+#   into one palette (for grayscale/palette tiles) and one 3d color lut (for rgb images)
+# - tables are cached per style values and shared by all renders of a process
+
+_style_contrast_scale = 12.0
+_style_color_lut_size = 65
+
+def _style_contrast(value, boost_contrast):
+    if not boost_contrast:
+        return value
+    return max(0, min(255, int(255.0 - ((255.0 - value) * _style_contrast_scale))))
+
+def _style_gray(rgb):
+    # grayscale conversion as in PIL's convert("L")
+    return (rgb[0] * 19595 + rgb[1] * 38470 + rgb[2] * 7471 + 0x8000) >> 16
+
+@functools.lru_cache(maxsize=32)
+def _create_style_tables(boost_contrast, background, foreground):
+    # colorize table (as in ImageOps.colorize), indexed by gray value after contrast boost
+    colors = [tuple(background[c] + i * (foreground[c] - background[c]) // 255 for c in range(3)) for i in range(256)]
+    contrast = [_style_contrast(i, boost_contrast) for i in range(256)]
+    # palette for gray values (contrast boost doesn't change gray pixels' gray value)
+    gray_palette = []
+    for i in range(256):
+        gray_palette.extend(colors[contrast[i]])
+    # 3d lut for rgb values (r changes fastest)
+    size = _style_color_lut_size
+    grid = [contrast[int(round(i * 255.0 / (size - 1)))] for i in range(size)]
+    table = []
+    for b in grid:
+        for g in grid:
+            for r in grid:
+                table.extend(c / 255.0 for c in colors[_style_gray((r, g, b))])
+    color_lut = ImageFilter.Color3DLUT(size, table)
+    return (colors, contrast, gray_palette, color_lut)
+
+
 class MapStyle:
     """Map style"""
 
@@ -93,8 +170,16 @@ class MapStyle:
         self.marker_size_mm = (8, 8)
         self.marker_style = "none"
         self.marker_opacity = 1.0
+        self.track_color = (200, 30, 30)
+        self.track_width_mm = 0.75
+        self.track_opacity = 0.8
+        self.heatmap_radius_mm = 2.0
+        self.heatmap_opacity = 0.8
+        self.heatmap_colors = [(200, 30, 30), (255, 220, 60)]
 
         # load values from dict
+        if "provider" in config:
+            self.style = config["provider"]
         if "foreground" in config:
             self.foreground = tuple(config["foreground"])
         if "background" in config:
@@ -108,226 +193,721 @@ class MapStyle:
                 self.marker_style = config["marker"]["style"]
             if "opacity" in config["marker"]:
                 self.marker_opacity = config["marker"]["opacity"]
+        if "track" in config:
+            if "color" in config["track"]:
+                self.track_color = tuple(config["track"]["color"])
+            if "width_mm" in config["track"]:
+                self.track_width_mm = config["track"]["width_mm"]
+            if "opacity" in config["track"]:
+                self.track_opacity = config["track"]["opacity"]
+        if "heatmap" in config:
+            if "radius_mm" in config["heatmap"]:
+                self.heatmap_radius_mm = config["heatmap"]["radius_mm"]
+            if "opacity" in config["heatmap"]:
+                self.heatmap_opacity = config["heatmap"]["opacity"]
+            if "colors" in config["heatmap"]:
+                self.heatmap_colors = [tuple(color) for color in config["heatmap"]["colors"]]
+
+    def get_style_hash(self):
+        # hash of all values that affect stylized tiles (changes if the style json changes)
+        values = {
+            "boost_contrast": bool(self.boost_contrast),
+            "background": list(self.background),
+            "foreground": list(self.foreground),
+            "contrast_scale": _style_contrast_scale,
+            "color_lut_size": _style_color_lut_size,
+        }
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def get_style_tables(self):
+        return _create_style_tables(bool(self.boost_contrast), tuple(self.background), tuple(self.foreground))
+
+    def get_color(self, rgb):
+        # styled color of a single rgb color
+        colors, contrast, gray_palette, color_lut = self.get_style_tables()
+        return colors[_style_gray([contrast[c] for c in rgb[0:3]])]
+
+    def stylize_image(self, image):
+        # apply style to image (tile or whole map) in a single pass
+        colors, contrast, gray_palette, color_lut = self.get_style_tables()
+        if image.mode == "L":
+            # palette lookup only (no pass over the pixels)
+            image = image.copy()
+            image.putpalette(gray_palette)
+            return image
+        if image.mode == "P":
+            # restyle palette entries
+            palette = image.getpalette()
+            styled_palette = []
+            for i in range(0, len(palette) - 2, 3):
+                styled_palette.extend(self.get_color(palette[i:i + 3]))
+            image = image.copy()
+            image.putpalette(styled_palette)
+            return image
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if not self.boost_contrast:
+            # without contrast boost, rgb->gray is linear and followed by a palette lookup
+            image = image.convert("L")
+            image.putpalette(gray_palette)
+            return image.convert("RGB")
+        return image.filter(color_lut)
 
 
 class MapTileProvider:
     """Map tile provider class"""
 
+    # provider definitions (name -> url template(s), subdomains, mirrors, hedging percentile, copyright)
+    providers_file = "resources/tile_providers.json"
+    # number of stylized tile contents kept for reuse by identical tiles (e.g. blank water tiles)
+    max_styled_contents = 64
+
     def _create_map_tile_providers():
-        provider_toner = {
-            "name": "toner",
-            "url": "http://tile.stamen.com/toner-background/{0}/{1}/{2}.png",
-            "copyright": "Map tiles by Stamen Design, under CC BY 3.0. Data by OpenStreetMap, under ODbL.",
-            "web": "http://maps.stamen.com/toner",
-        }
-        providers = {
-            "toner": provider_toner,
-        }
+        with open(MapTileProvider.providers_file, "r") as f:
+            providers = json.load(f)
+        for name, provider in providers.items():
+            provider["name"] = name
         return providers
 
-    def __init__(self, map_style, tiles_folder, use_cache):
+    def create_archive_provider(filename):
+        # provider for tiles from a local MBTiles/PMTiles archive
+        return {
+            "name": os.path.splitext(os.path.basename(filename))[0],
+            "archive": filename,
+        }
+
+    def __init__(self, map_style, tiles_folder, use_cache, num_workers=8, cache=None, cache_styled=False):
         # increase max image size for outputting HR maps
         Image.MAX_IMAGE_PIXELS = 933120000 # or 231952900
 
-        # find map tile provider
-        providers = MapTileProvider._create_map_tile_providers()
-        if map_style in providers:
-            self.provider = providers[map_style]
+        # find map tile provider (or use given provider definition)
+        if isinstance(map_style, dict):
+            self.provider = map_style
         else:
-            self.provider = providers["toner"]
+            providers = MapTileProvider._create_map_tile_providers()
+            self.provider = providers[map_style] if map_style in providers else providers["toner"]
+
+        # local tile archive (tiles are read directly from the archive, no downloads)
+        self.source = None
+        self.hosts = None
+        if "archive" in self.provider:
+            self.source = open_tile_archive(self.provider["archive"])
+        else:
+            self.hosts = TileHostPool(self.provider)
 
-        self.tiles_folder = tiles_folder + "{0}/{1}/{2}/"
-        self.tiles_file = self.tiles_folder + "/{3}.png"
+        # tile cache (memory + disk by default, any object with the TileCache interface can be plugged in)
         self.use_cache = use_cache
+        if use_cache and cache is None:
+            cache = TileCache(tiles_folder)
+        self.cache = cache if use_cache else None
+        self.num_revalidated = 0
+        # download statistics
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_download_errors = 0
+        self.num_bytes_downloaded = 0
+        # optional second cache level for stylized tiles (stored in the tile cache next to the raw tiles)
+        self.cache_styled = cache_styled and self.cache is not None
+        self.num_styled_hits = 0
+        self.num_styled_misses = 0
+        self.num_styled_shared = 0
+        # recently stylized tiles by style and content hash of the raw tile (identical tiles are stylized once)
+        self.styled_contents = MemoryTileCache(MapTileProvider.max_styled_contents)
+        self.stats_lock = threading.Lock()
+
+        # shared connection pool (keep-alive connections are reused by all download workers),
+        # with several hosts a failed request is retried less often on the same host (failover to other hosts instead)
+        self.num_workers = num_workers
+        num_retries = 5 if self.hosts is None or len(self.hosts.hosts) == 1 else 1
+        retries = urllib3.util.Retry(total=num_retries, backoff_factor=0.25, status_forcelist=(429, 500, 502, 503, 504))
+        self.http = urllib3.PoolManager(maxsize=2 * num_workers, block=True, retries=retries,
+                                        timeout=urllib3.util.Timeout(connect=5.0, read=30.0),
+                                        headers={"User-Agent": "MapPosterizer"})
+        # threads for hedged requests (created on demand)
+        self.hedge_executor = None
+        if self.hosts is not None and self.hosts.hedge_percentile is not None:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=2 * num_workers)
+
+    def _make_tile_key(self, zoom, tile_x, tile_y):
+        return (self.provider["name"], zoom, tile_x, tile_y)
+
+    def _make_styled_tile_key(self, zoom, tile_x, tile_y, style):
+        return (self.provider["name"] + "@" + style.get_style_hash(), zoom, tile_x, tile_y)
+
+    def _download_url(self, url, headers=None):
+        # retries with exponential backoff are handled by the connection pool
+        try:
+            response = self.http.request("GET", url, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            logger.warning("Download error " + url + ": " + str(e))
+            with self.stats_lock:
+                self.num_requests += 1
+                self.num_download_errors += 1
+            return None
+        with self.stats_lock:
+            self.num_requests += 1
+            self.num_retries += len(response.retries.history) if response.retries is not None else 0
+            self.num_bytes_downloaded += len(response.data)
+            if response.status not in (200, 304):
+                self.num_download_errors += 1
+        if response.status not in (200, 304):
+            logger.warning("Download error " + url + ": HTTP " + str(response.status))
+            return None
+        return response
+
+    def _request_tile(self, host, zoom, tile_x, tile_y, headers):
+        # request tile from a single host (host statistics are updated)
+        start = time.perf_counter()
+        response = self._download_url(host.get_url(zoom, tile_x, tile_y), headers)
+        if response is None:
+            self.hosts.record_error(host)
+        else:
+            self.hosts.record_success(host, time.perf_counter() - start)
+        return response
+
+    def _download_tile_response(self, zoom, tile_x, tile_y, headers):
+        # request tile from the hosts of the provider: on errors, the next host is tried. if hedging is enabled and
+        # a request takes longer than the latency percentile, a duplicate request is sent to the next host.
+        hosts = self.hosts.get_hosts(tile_x, tile_y)
+        hedge_delay = self.hosts.get_hedge_delay()
+        if hedge_delay is None:
+            for host in hosts:
+                response = self._request_tile(host, zoom, tile_x, tile_y, headers)
+                if response is not None:
+                    return response
+            return None
 
-    def make_tiles_dir(self, zoom, tile_y):
-        tile_dir = self.tiles_folder.format(self.provider["name"], zoom, tile_y)
-        if not os.path.exists(tile_dir):
-            os.makedirs(tile_dir)
-
-    def _make_tile_filename(self, zoom, tile_x, tile_y):
-        return self.tiles_file.format(self.provider["name"], zoom, tile_y, tile_x)
-
-    def _download_url(self, url):
-        for i in range(5):
-            try: 
-                # print("downloading (trial " + str(i) + ") " + url)
-                response = urllib.request.urlopen(url)
-                content = response.read()
-                response.close()
-            except urllib.error.URLError as e:  
-                print("Download URLError " + str(e.reason))
-                content = bytes()
-            except urllib.error.HTTPError as e:
-                print("Download HTTPError " + str(e.reason))
-                content = bytes()
-            except ConnectionResetError as e:
-                print("Download ConnectionResetError ")
-                content = bytes()
-            else:
-                break
-        return content
-
-    def _download_image(self, url):
-        content = self._download_url(url)
-        tile_image = Image.open(BytesIO(content))
+        next_host = 0
+        pending = set()
+        hedged = False
+        while True:
+            if not pending:
+                if next_host >= len(hosts):
+                    return None
+                pending.add(self.hedge_executor.submit(self._request_tile, hosts[next_host], zoom, tile_x, tile_y, headers))
+                next_host += 1
+            done, pending = wait(pending, timeout=None if hedged else hedge_delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                response = future.result()
+                if response is not None:
+                    return response
+            if not done:
+                # slow request: hedge with the next host (or the same host if there is only one)
+                hedged = True
+                host = hosts[next_host % len(hosts)]
+                next_host += 1
+                self.hosts.record_hedge(host)
+                pending.add(self.hedge_executor.submit(self._request_tile, host, zoom, tile_x, tile_y, headers))
+
+    def _decode_image(self, content, url):
+        try:
+            tile_image = Image.open(BytesIO(content))
+            tile_image.load()
+        except (OSError, SyntaxError) as e:
+            logger.warning("Invalid tile image " + url + ": " + str(e))
+            return None
         return tile_image
 
+    def is_tile_cached(self, zoom, tile_x, tile_y):
+        return self.use_cache and self.cache.contains(self._make_tile_key(zoom, tile_x, tile_y))
+
+    def is_tile_fresh(self, zoom, tile_x, tile_y):
+        # tile is cached and doesn't need to be revalidated
+        if not self.use_cache:
+            return False
+        record = self.cache.get_info(self._make_tile_key(zoom, tile_x, tile_y))
+        return record is not None and not self.cache.is_stale(record)
+
+    def get_average_tile_size(self):
+        # average size of cached tiles in bytes (None if unknown)
+        return self.cache.get_average_size(self.provider["name"]) if self.use_cache else None
+
+    def are_tiles_cached(self, zoom, tiles):
+        # all tiles are available without downloads (always true for tile archives)
+        if self.source is not None:
+            return True
+        return all(self.is_tile_cached(zoom, x, y) for (x, y) in tiles)
+
     def download_tile(self, zoom, tile_x, tile_y, save_image):
-        # download file if it doesn't exist
-        tile_file = self._make_tile_filename(zoom, tile_x, tile_y)
-        if not os.path.isfile(tile_file) or not self.use_cache:
-            tile_url = self.provider["url"].format(zoom, tile_x, tile_y)
-            tile_image = self._download_image(tile_url)
-            if save_image:
-                tile_image.save(tile_file, "PNG")
-            return tile_image
-        else:
+        # download tile if it isn't cached or stale (returns None if cached or if the download failed)
+        tile_key = self._make_tile_key(zoom, tile_x, tile_y)
+        headers = {}
+        if self.use_cache:
+            record = self.cache.get_info(tile_key)
+            if record is not None:
+                if not self.cache.is_stale(record):
+                    return None
+                # revalidate stale tile with conditional request
+                if record.etag:
+                    headers["If-None-Match"] = record.etag
+                if record.last_modified:
+                    headers["If-Modified-Since"] = record.last_modified
+
+        response = self._download_tile_response(zoom, tile_x, tile_y, headers)
+        if response is None:
             return None
+        tile_name = self.provider["name"] + "/" + str(zoom) + "/" + str(tile_x) + "/" + str(tile_y)
+        if response.status == 304:
+            self.cache.refresh(tile_key)
+            with self.stats_lock:
+                self.num_revalidated += 1
+            return None
+        if not response.data:
+            logger.warning("Download error " + tile_name + ": empty response")
+            return None
+        tile_image = self._decode_image(response.data, tile_name)
+        if tile_image is not None and save_image and self.use_cache:
+            self.cache.put(tile_key, response.data, response.headers.get("ETag"), response.headers.get("Last-Modified"), tile_image)
+            if headers:
+                # tile changed on server, drop stylized versions of the old tile
+                self.cache.remove_variants(tile_key)
+        return tile_image
+
+    def fetch_tile(self, zoom, tile_x, tile_y):
+        # make sure a fresh tile is available in the cache, returns False on failure
+        if self.download_tile(zoom, tile_x, tile_y, True) is not None:
+            return True
+        return self.is_tile_cached(zoom, tile_x, tile_y)
+
+    def fetch_tiles(self, zoom, tiles, progress=None):
+        # fetch tiles with a bounded pool of workers, returns list of failed tiles
+        if self.source is not None:
+            # check availability of all tiles in archive with one batched lookup
+            found = self.source.find_tiles(zoom, tiles)
+            return sorted(t for t in tiles if t not in found)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {executor.submit(self.fetch_tile, zoom, x, y): (x, y) for (x, y) in tiles}
+            for counter, future in enumerate(as_completed(futures), 1):
+                if progress is not None:
+                    progress(counter, len(futures))
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logger.warning("   tile download error: " + str(futures[future]) + ": " + str(e))
+                    ok = False
+                if not ok:
+                    failed.append(futures[future])
+        return sorted(failed)
 
     def load_tile(self, zoom, tile_x, tile_y):
-        if self.use_cache:
-            # load tile from disk
-            tile_file = self._make_tile_filename(zoom, tile_x, tile_y)
-            if os.path.isfile(tile_file):
-                return Image.open(tile_file)
-            else:
-                return None
+        if self.source is not None:
+            # load tile from archive
+            content = self.source.get_tile(zoom, tile_x, tile_y)
+            return self._decode_image(content, self.provider["archive"]) if content else None
+        elif self.use_cache:
+            # load tile from memory or disk cache
+            return self.cache.get_image(self._make_tile_key(zoom, tile_x, tile_y))
         else:
             return self.download_tile(zoom, tile_x, tile_y, False)
-    
+
+    def _load_hashed_tiles(self, zoom, tiles, batch_size=256):
+        # load several tiles, yields ((tile_x, tile_y), content hash or None, tile image or None).
+        # tiles with identical content are decoded once and share one image.
+        if self.source is None:
+            for (x, y) in tiles:
+                if self.use_cache:
+                    content_hash = self.cache.get_hash(self._make_tile_key(zoom, x, y))
+                    tile_image = self.cache.get_image_by_hash(content_hash) if content_hash is not None else None
+                    yield ((x, y), content_hash, tile_image)
+                else:
+                    yield ((x, y), None, self.download_tile(zoom, x, y, False))
+            return
+        # batched archive reads
+        tiles = list(tiles)
+        for i in range(0, len(tiles), batch_size):
+            batch = tiles[i:i + batch_size]
+            contents = self.source.get_tiles(zoom, batch)
+            decoded = {}
+            for tile in batch:
+                content = contents.get(tile)
+                if not content:
+                    yield (tile, None, None)
+                    continue
+                content_hash = get_content_hash(content)
+                if content_hash not in decoded:
+                    decoded[content_hash] = self._decode_image(content, self.provider["archive"])
+                yield (tile, content_hash, decoded[content_hash])
+
+    def load_tiles(self, zoom, tiles, batch_size=256):
+        # load several tiles, yields ((tile_x, tile_y), tile image or None)
+        for (tile, content_hash, tile_image) in self._load_hashed_tiles(zoom, tiles, batch_size):
+            yield (tile, tile_image)
+
+    def _stylize_tile(self, tile_image, content_hash, style):
+        # stylized tile and its png data (None without cache for stylized tiles), tiles with the same content
+        # are stylized and encoded once
+        key = (style.get_style_hash(), content_hash)
+        if content_hash is not None:
+            styled = self.styled_contents.get(key)
+            if styled is not None:
+                with self.stats_lock:
+                    self.num_styled_shared += 1
+                return styled
+        tile_image = style.stylize_image(tile_image)
+        data = None
+        if self.cache_styled:
+            content = BytesIO()
+            tile_image.save(content, "PNG")
+            data = content.getvalue()
+        styled = (tile_image, data)
+        if content_hash is not None:
+            self.styled_contents.put(key, styled)
+        return styled
+
+    def load_styled_tiles(self, zoom, tiles, style):
+        # load tiles with map style applied, yields ((tile_x, tile_y), styled tile image or None).
+        # stylized tiles are cached per style (if enabled), so repeated renders skip decoding and colorization.
+        if not self.cache_styled:
+            for (tile, content_hash, tile_image) in self._load_hashed_tiles(zoom, tiles):
+                yield (tile, self._stylize_tile(tile_image, content_hash, style)[0] if tile_image is not None else None)
+            return
+
+        missing = []
+        for (x, y) in tiles:
+            tile_image = self.cache.get_image(self._make_styled_tile_key(zoom, x, y, style))
+            if tile_image is None:
+                missing.append((x, y))
+            else:
+                yield ((x, y), tile_image)
+        with self.stats_lock:
+            self.num_styled_hits += len(tiles) - len(missing)
+            self.num_styled_misses += len(missing)
+        for ((x, y), content_hash, tile_image) in self._load_hashed_tiles(zoom, missing):
+            if tile_image is not None:
+                tile_image, data = self._stylize_tile(tile_image, content_hash, style)
+                self.cache.put(self._make_styled_tile_key(zoom, x, y, style), data, tile_image=tile_image)
+            yield ((x, y), tile_image)
+
+    def get_host_stats(self):
+        # statistics per host (empty for tile archives)
+        return self.hosts.get_stats() if self.hosts is not None else {}
+
+    def get_stats(self):
+        stats = {"requests": self.num_requests, "retries": self.num_retries, "download_errors": self.num_download_errors,
+                 "bytes_downloaded": self.num_bytes_downloaded, "revalidated": self.num_revalidated,
+                 "styled_hits": self.num_styled_hits, "styled_misses": self.num_styled_misses,
+                 "styled_shared": self.num_styled_shared}
+        if self.use_cache:
+            stats.update(self.cache.get_stats())
+        return stats
+
 
 class Map:
     """Map class"""
 
     tile_size_px = (256, 256)
-
-    def __init__(self, style, size_mm, dpi, corner_tl_deg, corner_br_deg, zoom):
+    # number of tiles drawn by a worker at once
+    draw_chunk_size = 16
+    # lowest zoom level of previews
+    preview_min_zoom = 10
+
+    def get_zoom_candidates(size_mm, dpi, corner_tl_deg, corner_br_deg, zooms=None):
+        # estimate raw map size, pixel density (raw px per output px) and number of tiles for all (or the given) zoom levels
+        if zooms is None:
+            zooms = range(MapLocation.min_zoom, MapLocation.max_zoom + 1)
+        size_px = mm_to_pixels_tuple(size_mm, dpi)
+        sides_ratio = float(size_px[1]) / size_px[0]
+        candidates = []
+        for zoom in zooms:
+            corner_tl_xy = degToXY(corner_tl_deg[0], corner_tl_deg[1], zoom)
+            corner_br_xy = degToXY(corner_br_deg[0], corner_br_deg[1], zoom)
+            width = corner_br_xy[0] - corner_tl_xy[0]
+            corner_br_xy = (corner_br_xy[0], corner_tl_xy[1] + width * sides_ratio)
+            num_tiles = (int(corner_br_xy[0] - 1) // Map.tile_size_px[0] - int(corner_tl_xy[0]) // Map.tile_size_px[0] + 1,
+                         int(corner_br_xy[1] - 1) // Map.tile_size_px[1] - int(corner_tl_xy[1]) // Map.tile_size_px[1] + 1)
+            candidates.append({
+                "zoom": zoom,
+                "raw_size_px": (int(width), int(width * sides_ratio)),
+                "density": width / size_px[0],
+                "num_tiles": num_tiles[0] * num_tiles[1],
+            })
+        return candidates
+
+    def select_zoom(size_mm, dpi, corner_tl_deg, corner_br_deg, bias=0.0, candidates=None):
+        # lowest zoom level whose pixel density meets the output resolution
+        # (bias > 0 selects more detailed zoom levels: the required density is 2^bias)
+        if candidates is None:
+            candidates = Map.get_zoom_candidates(size_mm, dpi, corner_tl_deg, corner_br_deg)
+        for candidate in candidates:
+            if candidate["density"] >= 2.0 ** bias:
+                return candidate["zoom"]
+        return candidates[-1]["zoom"]
+
+    def select_preview_zoom(size_mm, dpi, corner_tl_deg, corner_br_deg, max_zoom, tile_provider=None):
+        # zoom level for a preview at low dpi: lowest zoom level (from preview_min_zoom up to max_zoom) whose pixel
+        # density meets the preview resolution, a more detailed zoom level is taken if all of its tiles are cached
+        candidates = Map.get_zoom_candidates(size_mm, dpi, corner_tl_deg, corner_br_deg, range(Map.preview_min_zoom, max_zoom + 1))
+        zoom = Map.select_zoom(size_mm, dpi, corner_tl_deg, corner_br_deg, 0.0, candidates)
+        if tile_provider is None:
+            return zoom
+        for candidate_zoom in range(zoom, max_zoom + 1):
+            map = Map(None, size_mm, dpi, corner_tl_deg, corner_br_deg, candidate_zoom, tile_provider=tile_provider)
+            if tile_provider.are_tiles_cached(candidate_zoom, map.get_tiles()):
+                return candidate_zoom
+        return zoom
+
+    def __init__(self, style, size_mm, dpi, corner_tl_deg, corner_br_deg, zoom, num_workers=8, tile_provider=None, num_draw_workers=None):
         self.style = style
-        # create map tile provider
-        self.map_tile_provider = MapTileProvider(style.style, "cache/", True)
+        # number of threads for decoding and drawing tiles
+        self.num_draw_workers = num_draw_workers if num_draw_workers is not None else (os.cpu_count() or 1)
+        # create map tile provider (unless a provider is given)
+        if tile_provider is None:
+            tile_provider = MapTileProvider(style.style, "cache/", True, num_workers)
+        self.map_tile_provider = tile_provider
         # map size and resolution
         self.size_px = mm_to_pixels_tuple((size_mm[0], size_mm[1]), dpi)
         sides_ratio = float(self.size_px[1]) / self.size_px[0]
         self.dpi = dpi
         self.zoom = zoom
 
-        # compute tile grid dimensions
-        corner_tl_tile, corner_br_tile = degToCornerTiles(corner_tl_deg, corner_br_deg, self.zoom)
-        num_tiles = numTilesFromCorners(corner_tl_tile, corner_br_tile, make_squared=True)
-        # align vertical tiles with map sides ratio
-        num_tiles = (num_tiles[0], int(math.ceil(float(num_tiles[0]) * sides_ratio)))
-        # update br tile to account for squared grid
-        corner_br_tile = (corner_tl_tile[0] + num_tiles[0], corner_tl_tile[1] + num_tiles[1])
-        # calculate raw map size
-        self.raw_size_px = (num_tiles[0] * Map.tile_size_px[0], num_tiles[1] * Map.tile_size_px[1])
-
-        # compute global tiles locations
-        self.num_tiles = num_tiles
-        self.corner_tl_tile = corner_tl_tile
-        self.corner_br_tile = corner_br_tile
         # compute global xy locations on tiles
         corner_tl_xy = degToXY(corner_tl_deg[0], corner_tl_deg[1], self.zoom)
         corner_br_xy = degToXY(corner_br_deg[0], corner_br_deg[1], self.zoom)
         # align bottom right xy location with map sides ratio
         corner_br_xy = (corner_br_xy[0], corner_tl_xy[1] + (corner_br_xy[0] - corner_tl_xy[0]) * sides_ratio)
+
+        # raw map covers the crop region with whole pixels, its origin is the global pixel location of the tl corner
+        self.origin_px = (int(corner_tl_xy[0]), int(corner_tl_xy[1]))
+        self.raw_size_px = (int(math.ceil(corner_br_xy[0])) - self.origin_px[0], int(math.ceil(corner_br_xy[1])) - self.origin_px[1])
+        # exact crop region in local raw pixels (sub-pixel): the map is resampled from this region, so the
+        # framing is the same for all zoom levels and resolutions (previews match the final poster)
+        self.crop_box_px = (corner_tl_xy[0] - self.origin_px[0], corner_tl_xy[1] - self.origin_px[1],
+                            corner_br_xy[0] - self.origin_px[0], corner_br_xy[1] - self.origin_px[1])
         # compute tl and br in local pixels
-        self.corner_tl_px_x = int(corner_tl_xy[0] - self.corner_tl_tile[0] * Map.tile_size_px[0])
-        self.corner_tl_px_y = int(corner_tl_xy[1] - self.corner_tl_tile[1] * Map.tile_size_px[1])
-        self.corner_br_px_x = int(corner_br_xy[0] - self.corner_tl_tile[0] * Map.tile_size_px[0])
-        self.corner_br_px_y = int(corner_br_xy[1] - self.corner_tl_tile[1] * Map.tile_size_px[1])
+        self.corner_tl_px_x = 0
+        self.corner_tl_px_y = 0
+        self.corner_br_px_x = self.raw_size_px[0]
+        self.corner_br_px_y = self.raw_size_px[1]
+
+        # compute global tile locations of all tiles intersecting the crop region (br tile is exclusive)
+        self.corner_tl_tile = self._get_tile((0, 0))
+        corner_br_tile = self._get_tile((self.raw_size_px[0] - 1, self.raw_size_px[1] - 1))
+        self.corner_br_tile = (corner_br_tile[0] + 1, corner_br_tile[1] + 1)
+        self.num_tiles = (self.corner_br_tile[0] - self.corner_tl_tile[0], self.corner_br_tile[1] - self.corner_tl_tile[1])
 
-        # create raw map image
-        self.image_raw = Image.new("RGB", self.raw_size_px, "white")
+        # raw map image (allocated when drawing, not needed for band-wise rendering)
+        self.image_raw = None
+        self.is_stylized = False
+
+    def _get_tile(self, local_px):
+        # tile containing local raw pixel location
+        return ((self.origin_px[0] + local_px[0]) // Map.tile_size_px[0], (self.origin_px[1] + local_px[1]) // Map.tile_size_px[1])
+
+    def get_tiles(self):
+        # all tiles of the map (row by row)
+        return [(x, y) for y in range(self.corner_tl_tile[1], self.corner_br_tile[1], 1)
+                       for x in range(self.corner_tl_tile[0], self.corner_br_tile[0], 1)]
 
     def download_tiles(self):
-        if self.map_tile_provider.use_cache:
-            # download all tiles images
-            print ("downloading tiles ... ")
-            num_tiles = self.num_tiles[0] * self.num_tiles[1]
-            counter = 1
-            for y in range(self.corner_tl_tile[1], self.corner_br_tile[1], 1):
-                download_threads = []
-                for x in range(self.corner_tl_tile[0], self.corner_br_tile[0], 1):
-                    if counter % 20 == 0:
-                        print ("   tile " + str(counter) + " of " + str(num_tiles))
-                    counter = counter + 1
-
-                    # create tile folder
-                    self.map_tile_provider.make_tiles_dir(self.zoom, y)
-                    # get tile images (multi-threaded)
-                    current_thread = threading.Thread(target=self.map_tile_provider.download_tile, args=(self.zoom, x, y, True, ))
-                    download_threads.append(current_thread)
-                    current_thread.start()
-
-                # wait for all threads to finish
-                for t in download_threads:
-                    t.join()
-
-    def draw(self):
-        # draw all tile images
-        print ("drawing tiles ... ")
-        num_tiles = self.num_tiles[0] * self.num_tiles[1]
-        counter = 1
-        for y in range(self.corner_tl_tile[1], self.corner_br_tile[1], 1):
-            for x in range(self.corner_tl_tile[0], self.corner_br_tile[0], 1):
-                if counter % 20 == 0:
-                    print ("   tile " + str(counter) + " of " + str(num_tiles))
-                counter = counter + 1
-
-                # load tile image
-                tile_image = self.map_tile_provider.load_tile(self.zoom, x, y)
-                if tile_image is None:
-                    print("   tile does not exist: zoom=" + str(self.zoom) + ", tile_x=" + str(x) + ", tile_y=" + str(y)) 
-                else:
-                    # insert tile image into output image
-                    subimage_x = (x - self.corner_tl_tile[0]) * Map.tile_size_px[0]
-                    subimage_y = (y - self.corner_tl_tile[1]) * Map.tile_size_px[1]
-                    self.image_raw.paste(tile_image,(subimage_x, subimage_y))
-                    tile_image.close()
+        # download all tiles images, returns list of tiles that could not be downloaded
+        if not self.map_tile_provider.use_cache and self.map_tile_provider.source is None:
+            return []
+        logger.info("downloading tiles ... ")
+
+        def progress(counter, num_tiles):
+            if counter % 20 == 0:
+                logger.info("   tile " + str(counter) + " of " + str(num_tiles))
+
+        failed = self.map_tile_provider.fetch_tiles(self.zoom, self.get_tiles(), progress)
+        for (x, y) in failed:
+            logger.warning("   tile download failed: zoom=" + str(self.zoom) + ", tile_x=" + str(x) + ", tile_y=" + str(y))
+        return failed
+
+    def draw(self, stylize=False):
+        # draw all tile images (stylize: apply map style to each tile before drawing it)
+        logger.info("drawing tiles ... ")
+        self.image_raw = self._create_image(self.raw_size_px, stylize)
+        self._draw_tiles(self.image_raw, self.get_tiles(), (0, 0), stylize, progress=True)
+        self.is_stylized = stylize
+
+    def _create_image(self, size, stylize):
+        background = self.style.get_color((255, 255, 255)) if stylize else (255, 255, 255)
+        return Image.new("RGB", size, background)
+
+    def _draw_tile_chunk(self, image, tiles, offset_px, stylize):
+        # load (and stylize) tiles and paste them into their regions of image
+        if stylize:
+            tile_images = self.map_tile_provider.load_styled_tiles(self.zoom, tiles, self.style)
+        else:
+            tile_images = self.map_tile_provider.load_tiles(self.zoom, tiles)
+        for ((x, y), tile_image) in tile_images:
+            if tile_image is None:
+                logger.warning("   tile does not exist: zoom=" + str(self.zoom) + ", tile_x=" + str(x) + ", tile_y=" + str(y)) 
+            else:
+                # insert tile image into output image
+                subimage_x = x * Map.tile_size_px[0] - self.origin_px[0] - offset_px[0]
+                subimage_y = y * Map.tile_size_px[1] - self.origin_px[1] - offset_px[1]
+                image.paste(tile_image,(subimage_x, subimage_y))
+        return len(tiles)
+
+    def _draw_tiles(self, image, tiles, offset_px, stylize, progress):
+        # paste tiles into image, offset_px is the local raw pixel location of the image origin.
+        # chunks of tiles are decoded and pasted by a pool of threads (tiles never overlap), the number
+        # of chunks in flight is limited so that only a few decoded tiles are kept in memory at a time.
+        num_tiles = len(tiles)
+        chunks = [tiles[i:i + Map.draw_chunk_size] for i in range(0, num_tiles, Map.draw_chunk_size)]
+        image.load()
+        counter = 0
+        with ThreadPoolExecutor(max_workers=self.num_draw_workers) as executor:
+            pending = set()
+            for i, chunk in enumerate(chunks):
+                pending.add(executor.submit(self._draw_tile_chunk, image, chunk, offset_px, stylize))
+                if len(pending) < 2 * self.num_draw_workers and i + 1 < len(chunks):
+                    continue
+                # wait for chunks to be finished (all of them after the last chunk has been submitted)
+                done, pending = wait(pending, return_when=FIRST_COMPLETED if i + 1 < len(chunks) else ALL_COMPLETED)
+                for future in done:
+                    drawn = future.result()
+                    if progress and (counter + drawn) // 20 > counter // 20:
+                        logger.info("   tile " + str(counter + drawn) + " of " + str(num_tiles))
+                    counter += drawn
 
     def crop_to_coords(self):
-        # crop image to tl and br region
+        # crop image to tl and br region (raw map is drawn for the crop region only, nothing to do then)
+        crop_box = (self.corner_tl_px_x, self.corner_tl_px_y, self.corner_br_px_x, self.corner_br_px_y)
+        if crop_box == (0, 0) + self.image_raw.size:
+            return
         self.image_raw = self.image_raw.crop((self.corner_tl_px_x, self.corner_tl_px_y, self.corner_br_px_x, self.corner_br_px_y))
         self.raw_size_px = self.image_raw.size
+        self.crop_box_px = (self.crop_box_px[0] - self.corner_tl_px_x, self.crop_box_px[1] - self.corner_tl_px_y,
+                            self.crop_box_px[2] - self.corner_tl_px_x, self.crop_box_px[3] - self.corner_tl_px_y)
         self.corner_tl_px_x = 0
         self.corner_tl_px_y = 0
-        self.corner_br_px_x = self.raw_size_px[0] - 1
-        self.corner_br_px_y = self.raw_size_px[1] - 1
+        self.corner_br_px_x = self.raw_size_px[0]
+        self.corner_br_px_y = self.raw_size_px[1]
 
     def get_cropped_size(self):
         # return size of cropped map
         return (self.corner_br_px_x - self.corner_tl_px_x, self.corner_br_px_y - self.corner_tl_px_y)
 
     def stylize(self):
-        if self.style.boost_contrast:
-            scale = 12.0
-            self.image_raw = self.image_raw.point(lambda i: 255.0 - ((255.0 - i) * scale))
-
-        self.image_raw = ImageOps.colorize(self.image_raw.convert('L'), black=self.style.background, white=self.style.foreground)
-
-    def draw_marker(self, coords):
-        if self.style.marker_style == "none":
+        # stylize raw map (unless tiles have been stylized while drawing)
+        if self.is_stylized:
             return
+        self.image_raw = self.style.stylize_image(self.image_raw)
+        self.is_stylized = True
 
-        # compute global xy location on tiles and pixel location
-        location_xy = degToXY(coords[0], coords[1], self.zoom)
-        location_px = (location_xy[0] - self.corner_tl_tile[0] * self.tile_size_px[0], location_xy[1] - self.corner_tl_tile[1] * self.tile_size_px[1])
+    def _get_map_scale(self):
+        # raw pixels per output pixel
+        return ((self.crop_box_px[2] - self.crop_box_px[0]) / self.size_px[0], (self.crop_box_px[3] - self.crop_box_px[1]) / self.size_px[1])
+
+    def project_to_output(self, lat, lon):
+        # output pixel locations of arrays of coordinates
+        x, y = degToXYArray(lat, lon, self.zoom)
+        map_scale_x, map_scale_y = self._get_map_scale()
+        return ((x - self.origin_px[0] - self.crop_box_px[0]) / map_scale_x, (y - self.origin_px[1] - self.crop_box_px[1]) / map_scale_y)
 
+    def _get_marker_size_px(self):
         # calculate marker size in px
-        map_scale_x = (self.corner_br_px_x - self.corner_tl_px_x) / self.size_px[0]
-        map_scale_y = (self.corner_br_px_y - self.corner_tl_px_y) / self.size_px[1]
+        map_scale_x, map_scale_y = self._get_map_scale()
         marker_size_px = mm_to_pixels_tuple(self.style.marker_size_mm, self.dpi)
-        marker_size_px = (int(marker_size_px[0] * map_scale_x), int(marker_size_px[1] * map_scale_y))
+        return (int(marker_size_px[0] * map_scale_x), int(marker_size_px[1] * map_scale_y))
 
+    def _draw_marker_px(self, image, location_px, marker_size_px):
         if self.style.marker_style == "heart":
-            draw_heart_svg(self.image_raw, location_px, marker_size_px[0], self.style.marker_opacity)
+            draw_heart_svg(image, location_px, marker_size_px[0], self.style.marker_opacity)
         else:
-            draw_circle(self.image_raw, location_px, marker_size_px[0] / 2, (128, 0, 0, 128), (255, 0, 0, 255))
+            draw_circle(image, location_px, marker_size_px[0] / 2, (128, 0, 0, 128), (255, 0, 0, 255))
+
+    def draw_marker(self, coords, image=None, offset_px=(0, 0)):
+        # draw marker into raw map image (or into a part of it starting at local raw pixel location offset_px)
+        if self.style.marker_style == "none":
+            return
+        if image is None:
+            image = self.image_raw
+
+        # compute global xy location on tiles and pixel location
+        location_xy = degToXY(coords[0], coords[1], self.zoom)
+        location_px = (location_xy[0] - self.origin_px[0] - offset_px[0], location_xy[1] - self.origin_px[1] - offset_px[1])
+        self._draw_marker_px(image, location_px, self._get_marker_size_px())
+
+    def draw_overlay(self, overlay, image=None, offset_px=(0, 0)):
+        # draw overlay tracks and markers into raw map image (or into a part of it, as in draw_marker)
+        if image is None:
+            image = self.image_raw
+        map_scale_x, map_scale_y = self._get_map_scale()
+        # tracks are simplified to half an output pixel
+        tracks_px, markers_px = overlay.get_projected(self.zoom, 0.5 * map_scale_x)
+        origin = np.array((self.origin_px[0] + offset_px[0], self.origin_px[1] + offset_px[1]), dtype=np.float64)
+
+        # clip tracks to image (with a margin of the line width)
+        width_px = max(1, int(round(mm_to_pixels(self.style.track_width_mm, self.dpi) * map_scale_x)))
+        margin = width_px
+        rect = (-margin, -margin, image.size[0] + margin, image.size[1] + margin)
+        parts = []
+        for track_px in tracks_px:
+            parts.extend(clip_polyline(track_px - origin, rect))
+        if parts:
+            # draw lines into a mask covering the drawn parts only and blend track color with it
+            points = np.concatenate(parts)
+            box = (max(0, int(points[:, 0].min()) - margin), max(0, int(points[:, 1].min()) - margin),
+                   min(image.size[0], int(points[:, 0].max()) + margin + 1), min(image.size[1], int(points[:, 1].max()) + margin + 1))
+            if box[0] < box[2] and box[1] < box[3]:
+                mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+                draw = ImageDraw.Draw(mask)
+                fill = int(255 * self.style.track_opacity)
+                for part in parts:
+                    # integer points (lines are drawn the same way in every band of band-wise rendering)
+                    part = np.floor(part - box[0:2] + 0.5).astype(np.int64)
+                    draw.line(part.ravel().tolist(), fill=fill, width=width_px, joint="curve")
+                image.paste(self.style.track_color, box, mask)
+
+        # draw markers close to the image
+        if self.style.marker_style == "none" or len(markers_px) == 0:
+            return
+        marker_size_px = self._get_marker_size_px()
+        local_px = markers_px - origin
+        visible = ((local_px[:, 0] >= -marker_size_px[0]) & (local_px[:, 0] <= image.size[0] + marker_size_px[0]) &
+                   (local_px[:, 1] >= -marker_size_px[1]) & (local_px[:, 1] <= image.size[1] + marker_size_px[1]))
+        for location_px in local_px[visible]:
+            self._draw_marker_px(image, (location_px[0], location_px[1]), marker_size_px)
 
     def get_scaled(self):
         # return resized map (Image.BICUBIC, Image.ANTIALIAS or better Image.LANCZOS?)
-        return self.image_raw.resize(self.size_px, resample=Image.LANCZOS)
+        return self.image_raw.resize(self.size_px, resample=Image.LANCZOS, box=self.crop_box_px)
+
+    def render_bands(self, target, offset, marker=None, band_rows=4, overlay=None):
+        # render map band-wise (tiles are stylized and drawn, cropped and resampled in horizontal bands
+        # of about band_rows tile rows each), the scaled map is written into target at offset.
+        # peak memory is bounded by the band size instead of the raw map size.
+        logger.info("rendering map in bands ... ")
+        crop_w = self.corner_br_px_x - self.corner_tl_px_x
+        scale_y = (self.crop_box_px[3] - self.crop_box_px[1]) / self.size_px[1]
+        # output rows per band and margin of source rows for the resampling filter (lanczos support: 3)
+        band_height = max(1, int(band_rows * Map.tile_size_px[1] / scale_y))
+        margin = int(math.ceil(3.0 * max(scale_y, 1.0))) + 1
+
+        tile_x0 = self._get_tile((self.corner_tl_px_x, 0))[0]
+        tile_x1 = self._get_tile((self.corner_br_px_x - 1, 0))[0] + 1
+        num_bands = int(math.ceil(self.size_px[1] / band_height))
+        for band, out_y0 in enumerate(range(0, self.size_px[1], band_height)):
+            out_y1 = min(out_y0 + band_height, self.size_px[1])
+            logger.info("   band " + str(band + 1) + " of " + str(num_bands))
+
+            # source rows (local raw pixels) required for this band, clipped to crop region
+            src_y0 = self.crop_box_px[1] + out_y0 * scale_y
+            src_y1 = self.crop_box_px[1] + out_y1 * scale_y
+            band_y0 = max(int(src_y0) - margin, self.corner_tl_px_y)
+            band_y1 = min(int(math.ceil(src_y1)) + margin, self.corner_br_px_y)
+
+            # draw tiles overlapping the band
+            tile_y0 = self._get_tile((0, band_y0))[1]
+            tile_y1 = self._get_tile((0, band_y1 - 1))[1] + 1
+            tiles = [(x, y) for y in range(tile_y0, tile_y1) for x in range(tile_x0, tile_x1)]
+            offset_px = (self.corner_tl_px_x, band_y0)
+            image_band = self._create_image((crop_w, band_y1 - band_y0), True)
+            self._draw_tiles(image_band, tiles, offset_px, True, progress=False)
+
+            # draw overlay and marker and resample band
+            if overlay is not None:
+                self.draw_overlay(overlay, image_band, offset_px)
+            if marker is not None:
+                self.draw_marker(marker, image_band, offset_px)
+            box = (self.crop_box_px[0] - self.corner_tl_px_x, src_y0 - band_y0, self.crop_box_px[2] - self.corner_tl_px_x, src_y1 - band_y0)
+            image_band = image_band.resize((self.size_px[0], out_y1 - out_y0), resample=Image.LANCZOS, box=box)
+            target.paste(image_band, (offset[0], offset[1] + out_y0))
 
     def __str__(self):
         output = str(__class__.__name__) + ":"
@@ -0,0 +1,75 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# --------------------------------------------------------------------
+# render metrics
+# - wall time of pipeline stages, counters (tiles, cache hits/misses, downloads, retries) and values (image sizes)
+# - peak memory (resident set size) of the process
+# - a hook is called at the end of each stage (e.g. for external monitoring), the report is a json-serializable dict
+
+def get_peak_rss_mb():
+    # peak resident set size of the process (None if not available on this platform)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes on linux
+    if sys.platform == "darwin":
+        return peak_rss / (1024.0 * 1024.0)
+    return peak_rss / 1024.0
+
+
+class Metrics:
+    """Render metrics"""
+
+    def __init__(self, hook=None):
+        # hook(stage name, seconds) is called at the end of each stage
+        self.hook = hook
+        self.stages = {}
+        self.counters = {}
+        self.values = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # measure wall time of a stage (times of repeated stages are summed up)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + duration
+            if self.hook is not None:
+                self.hook(name, duration)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def get_elapsed(self):
+        # wall time since metrics were created
+        return time.perf_counter() - self.start
+
+    def get_report(self):
+        with self.lock:
+            return {
+                "stages": dict(self.stages),
+                "total": self.get_elapsed(),
+                "counters": dict(self.counters),
+                "values": dict(self.values),
+                "peak_rss_mb": get_peak_rss_mb(),
+            }
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.get_report(), f, indent=4)
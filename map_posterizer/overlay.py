@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+from map_posterizer.geo_utils import degToXYArray
+
+# --------------------------------------------------------------------
+# map overlay
+# - tracks (polylines) and markers from GPX or GeoJSON files (or marker coordinates from the location file)
+# - all points are projected at once (vectorized), tracks are simplified to the output resolution
+#   and clipped to the drawn region before drawing
+# useful literature
+# - GPX format: https://www.topografix.com/gpx.asp
+# - GeoJSON format: https://datatracker.ietf.org/doc/html/rfc7946
+# - polyline simplification: https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+
+def _strip_namespace(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def _load_gpx(filename):
+    # tracks (track segments and routes) and waypoints of a gpx file
+    tracks = []
+    markers = []
+    points = []
+    try:
+        for event, elem in ElementTree.iterparse(filename, events=("start", "end")):
+            tag = _strip_namespace(elem.tag)
+            if event == "start":
+                if tag in ("trkseg", "rte"):
+                    points = []
+                continue
+            if tag in ("trkpt", "rtept", "wpt"):
+                point = (float(elem.attrib["lat"]), float(elem.attrib["lon"]))
+                if tag == "wpt":
+                    markers.append(point)
+                else:
+                    points.append(point)
+                elem.clear()
+            elif tag in ("trkseg", "rte"):
+                tracks.append(points)
+                points = []
+    except (ElementTree.ParseError, KeyError) as e:
+        raise ValueError("invalid gpx file " + filename + " (" + str(e) + ")")
+    return (tracks, markers)
+
+def _load_geojson(filename):
+    # tracks (line strings and polygon rings) and markers (points) of a geojson file
+    with open(filename, "r") as f:
+        data = json.load(f)
+    tracks = []
+    markers = []
+    geometries = [data]
+    while geometries:
+        geometry = geometries.pop()
+        if geometry is None:
+            continue
+        kind = geometry.get("type")
+        coords = geometry.get("coordinates")
+        # geojson positions are (lon, lat)
+        if kind == "FeatureCollection":
+            geometries.extend(reversed(geometry.get("features", [])))
+        elif kind == "Feature":
+            geometries.append(geometry.get("geometry"))
+        elif kind == "GeometryCollection":
+            geometries.extend(reversed(geometry.get("geometries", [])))
+        elif kind == "Point":
+            markers.append((coords[1], coords[0]))
+        elif kind == "MultiPoint":
+            markers.extend((c[1], c[0]) for c in coords)
+        elif kind == "LineString":
+            tracks.append([(c[1], c[0]) for c in coords])
+        elif kind in ("MultiLineString", "Polygon"):
+            tracks.extend([(c[1], c[0]) for c in line] for line in coords)
+        elif kind == "MultiPolygon":
+            tracks.extend([(c[1], c[0]) for c in ring] for polygon in coords for ring in polygon)
+        else:
+            raise ValueError("unsupported geojson type in " + filename + ": " + str(kind))
+    return (tracks, markers)
+
+def load_overlay_file(filename):
+    # tracks (lists of lat/lon points) and markers (lat/lon points) of a gpx or geojson file
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".gpx":
+        return _load_gpx(filename)
+    if ext in (".geojson", ".json"):
+        return _load_geojson(filename)
+    raise ValueError("unsupported overlay file: " + filename)
+
+
+def quantize_polyline(points, cell_size):
+    # drop consecutive points within the same grid cell (first and last point are kept)
+    cells = np.floor(points / cell_size)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+    keep[-1] = True
+    return points[keep]
+
+def simplify_polyline(points, tolerance):
+    # ramer-douglas-peucker simplification (max. deviation tolerance), iterative with numpy distances
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        direction = points[last] - start
+        inner = points[first + 1:last] - start
+        length = np.hypot(direction[0], direction[1])
+        if length == 0.0:
+            dist = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            dist = np.abs(direction[0] * inner[:, 1] - direction[1] * inner[:, 0]) / length
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+def clip_polyline(points, rect):
+    # parts of polyline whose segments intersect rect (x0, y0, x1, y1)
+    if len(points) < 2:
+        return []
+    p0 = points[:-1]
+    p1 = points[1:]
+    inside = ((np.minimum(p0[:, 0], p1[:, 0]) <= rect[2]) & (np.maximum(p0[:, 0], p1[:, 0]) >= rect[0]) &
+              (np.minimum(p0[:, 1], p1[:, 1]) <= rect[3]) & (np.maximum(p0[:, 1], p1[:, 1]) >= rect[1]))
+    segments = np.flatnonzero(inside)
+    if segments.size == 0:
+        return []
+    # runs of consecutive segments
+    breaks = np.flatnonzero(np.diff(segments) > 1)
+    starts = np.concatenate(([segments[0]], segments[breaks + 1]))
+    ends = np.concatenate((segments[breaks], [segments[-1]]))
+    return [points[start:end + 2] for (start, end) in zip(starts, ends)]
+
+
+class Overlay:
+    """Map overlay (tracks and markers)"""
+
+    def __init__(self, track_files=(), markers=()):
+        # tracks: arrays of lat/lon points, markers: array of lat/lon points
+        self.tracks = []
+        marker_points = []
+        for filename in track_files:
+            tracks, waypoints = load_overlay_file(filename)
+            self.tracks.extend(np.array(track, dtype=np.float64) for track in tracks if len(track) > 1)
+            marker_points.extend(waypoints)
+        for marker in markers:
+            if isinstance(marker, str):
+                # markers from file (points of tracks are ignored)
+                marker_points.extend(load_overlay_file(marker)[1])
+            else:
+                marker_points.append((float(marker[0]), float(marker[1])))
+        self.markers = np.array(marker_points, dtype=np.float64).reshape(-1, 2)
+
+        # projected and simplified geometry per zoom level and tolerance
+        self.projected = {}
+        self.lock = threading.Lock()
+
+    def get_projected(self, zoom, tolerance):
+        # global pixel locations of simplified tracks and markers (cached, e.g. for band-wise rendering)
+        key = (zoom, tolerance)
+        with self.lock:
+            if key not in self.projected:
+                tracks_px = []
+                for track in self.tracks:
+                    track_px = np.column_stack(degToXYArray(track[:, 0], track[:, 1], zoom))
+                    track_px = simplify_polyline(quantize_polyline(track_px, tolerance), tolerance)
+                    tracks_px.append(track_px)
+                markers_px = np.column_stack(degToXYArray(self.markers[:, 0], self.markers[:, 1], zoom))
+                self.projected[key] = (tracks_px, markers_px)
+            return self.projected[key]
+
+    def __str__(self):
+        output = str(__class__.__name__) + ":"
+        output += os.linesep + "   tracks: " + str(len(self.tracks)) + " (" + str(sum(len(track) for track in self.tracks)) + " points)"
+        output += os.linesep + "   markers: " + str(len(self.markers))
+        return output
@@ -0,0 +1,185 @@
+import csv
+import json
+import logging
+import math
+import operator
+import os
+import threading
+
+from geopy.exc import GeopyError
+
+from map_posterizer.geo_utils import geoCoordinatesToPlace
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# place lookups for captions
+# - PlaceCache: persistent cache of place names keyed by rounded coordinates
+# - Gazetteer: offline lookup of the nearest place from a local file (k-d tree over city locations)
+#   (csv with name/lat/lon columns or geonames tsv, e.g. cities15000.txt from https://download.geonames.org/export/dump/)
+# - PlaceLookup: cache -> gazetteer -> online reverse geocoding (geopy/Nominatim)
+
+class PlaceCache:
+    """Persistent place name cache"""
+
+    def __init__(self, filename, precision=3):
+        self.filename = filename
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.places = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "r") as f:
+                    self.places = json.load(f)
+            except ValueError:
+                logger.warning("invalid place cache " + filename + ", starting with empty cache")
+
+    def _make_key(self, coords):
+        return str(round(coords[0], self.precision)) + "," + str(round(coords[1], self.precision))
+
+    def get(self, coords):
+        with self.lock:
+            return self.places.get(self._make_key(coords))
+
+    def put(self, coords, place):
+        with self.lock:
+            self.places[self._make_key(coords)] = place
+            # write to temp file first (cache may be shared by several processes)
+            folder = os.path.dirname(self.filename)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            filename_tmp = self.filename + "." + str(os.getpid()) + ".tmp"
+            with open(filename_tmp, "w") as f:
+                json.dump(self.places, f, indent=0, sort_keys=True)
+            os.replace(filename_tmp, self.filename)
+
+
+def _to_unit_vector(lat, lon):
+    lat_rad = math.radians(lat)
+    lon_rad = math.radians(lon)
+    return (math.cos(lat_rad) * math.cos(lon_rad), math.cos(lat_rad) * math.sin(lon_rad), math.sin(lat_rad))
+
+
+class Gazetteer:
+    """Offline nearest place lookup"""
+
+    def __init__(self, filename):
+        self.names = []
+        points = []
+        for (name, lat, lon) in Gazetteer._read_places(filename):
+            self.names.append(name)
+            points.append(_to_unit_vector(lat, lon) + (len(points),))
+        if not points:
+            raise ValueError("no places in gazetteer " + filename)
+
+        # k-d tree over unit vectors (euclidean distance is monotonic in great-circle distance)
+        self.node_points = []
+        self.node_left = []
+        self.node_right = []
+        self.root = self._build(points, 0)
+
+    def _read_places(filename):
+        with open(filename, "r", encoding="utf-8", newline="") as f:
+            if filename.lower().endswith(".csv"):
+                # csv with header (name, lat/latitude, lon/lng/longitude)
+                for row in csv.DictReader(f):
+                    row = {key.strip().lower(): value for key, value in row.items() if key is not None}
+                    lat = row.get("lat", row.get("latitude"))
+                    lon = row.get("lon", row.get("lng", row.get("longitude")))
+                    if row.get("name") and lat and lon:
+                        yield (row["name"], float(lat), float(lon))
+            else:
+                # geonames tsv (name: column 1, latitude: column 4, longitude: column 5)
+                for line in f:
+                    columns = line.rstrip("\n").split("\t")
+                    if len(columns) > 5:
+                        yield (columns[1], float(columns[4]), float(columns[5]))
+
+    def _build(self, points, depth):
+        if not points:
+            return -1
+        axis = depth % 3
+        points.sort(key=operator.itemgetter(axis))
+        median = len(points) // 2
+        node = len(self.node_points)
+        self.node_points.append(points[median])
+        self.node_left.append(-1)
+        self.node_right.append(-1)
+        self.node_left[node] = self._build(points[:median], depth + 1)
+        self.node_right[node] = self._build(points[median + 1:], depth + 1)
+        return node
+
+    def find_nearest(self, coords):
+        # name of the nearest place
+        query = _to_unit_vector(coords[0], coords[1])
+        best = [None, float("inf")]
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node < 0:
+                continue
+            point = self.node_points[node]
+            dist = (point[0] - query[0]) ** 2 + (point[1] - query[1]) ** 2 + (point[2] - query[2]) ** 2
+            if dist < best[1]:
+                best = [point[3], dist]
+            axis = depth % 3
+            diff = query[axis] - point[axis]
+            near, far = (self.node_left[node], self.node_right[node]) if diff < 0 else (self.node_right[node], self.node_left[node])
+            # far side only needs to be searched if the splitting plane is closer than the best match
+            if diff * diff < best[1]:
+                stack.append((far, depth + 1))
+            stack.append((near, depth + 1))
+        return self.names[best[0]]
+
+
+class PlaceLookup:
+    """Place name lookup (cache, offline gazetteer and online geocoding)"""
+
+    def __init__(self, cache_file="cache/places.json", gazetteer_file=None, online=True):
+        self.cache = PlaceCache(cache_file) if cache_file is not None else None
+        self.gazetteer = Gazetteer(gazetteer_file) if gazetteer_file is not None else None
+        self.gazetteer_file = gazetteer_file
+        self.online = online
+
+    def lookup(self, coords):
+        if self.cache is not None:
+            place = self.cache.get(coords)
+            if place is not None:
+                return place
+
+        if self.gazetteer is not None:
+            place = self.gazetteer.find_nearest(coords)
+        elif self.online:
+            try:
+                place = geoCoordinatesToPlace(coords)
+            except (GeopyError, OSError) as e:
+                logger.warning("place lookup failed: " + str(e))
+                return ""
+        else:
+            return ""
+
+        if self.cache is not None:
+            self.cache.put(coords, place)
+        return place
+
+
+# process-wide place lookup (kept for all renders of a process)
+_place_lookup = None
+_place_lookup_lock = threading.Lock()
+
+def configure_place_lookup(cache_file="cache/places.json", gazetteer_file=None, online=True):
+    global _place_lookup
+    with _place_lookup_lock:
+        # keep current lookup (and its loaded gazetteer) if nothing changed
+        if _place_lookup is not None and _place_lookup.gazetteer_file == gazetteer_file and _place_lookup.online == online and \
+           (_place_lookup.cache.filename if _place_lookup.cache is not None else None) == cache_file:
+            return _place_lookup
+        _place_lookup = PlaceLookup(cache_file, gazetteer_file, online)
+        return _place_lookup
+
+def lookup_place(coords):
+    # place name for coordinates (e.g. city name)
+    lookup = _place_lookup
+    if lookup is None:
+        lookup = configure_place_lookup()
+    return lookup.lookup(coords)
@@ -0,0 +1,131 @@
+import logging
+
+from map_posterizer.drawing_utils import mm_to_pixels_tuple
+from map_posterizer.map import Map
+from map_posterizer.poster_job import PosterError, create_tile_provider, load_poster_config, select_zoom
+from map_posterizer.seed import TileSeeder
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# render planner
+# - estimates the cost of a poster job from the geometry of location, canvas and map only
+#   (no images are allocated and no tiles are fetched): number of tiles, uncached tiles, download size,
+#   peak memory of images and time of the pipeline stages
+# - jobs whose estimates exceed the budgets of the job (max_tiles, max_memory_mb, max_download_mb,
+#   max_seconds) are rejected before anything is rendered
+# - stage times are rough estimates (costs measured on a single core, tiles drawn by several workers)
+
+# seconds per tile (decoding, stylizing and drawing), per megapixel of the raw map (resampling),
+# per megapixel of the canvas (encoding)
+stage_costs = {
+    "draw": 0.005,
+    "get_scaled": 0.04,
+    "save": 0.035,
+}
+
+def _get_image_bytes(size_px, bands=3):
+    return size_px[0] * size_px[1] * bands
+
+def plan_poster(job, tile_provider=None):
+    # estimates of a job (dict), budget_errors lists all exceeded budgets
+    location, canvas_style, map_style = load_poster_config(job)
+    if job.zoom is not None:
+        location.zoom = job.zoom
+    content_size_mm = canvas_style.get_content_size_mm()
+    select_zoom(job, location, content_size_mm, verbose=False)
+    if tile_provider is None:
+        tile_provider = create_tile_provider(job, map_style)
+    map = Map(map_style, content_size_mm, job.dpi, location.top_left, location.bottom_right, location.zoom, job.workers, tile_provider)
+    canvas_size_px = mm_to_pixels_tuple(canvas_style.size_mm, job.dpi)
+
+    # tiles to fetch (tiles missing in a tile archive can't be fetched)
+    tiles = map.get_tiles()
+    if tile_provider.source is not None:
+        num_uncached = 0
+        num_missing = len(tiles) - len(tile_provider.source.find_tiles(map.zoom, tiles))
+    else:
+        num_uncached = sum(1 for (x, y) in tiles if not tile_provider.is_tile_fresh(map.zoom, x, y))
+        num_missing = 0
+    tile_bytes = tile_provider.get_average_tile_size() or TileSeeder.default_tile_bytes
+
+    # images in memory at the same time: canvas, scaled map and raw map (or one band of it),
+    # decoded tiles of the draw workers
+    memory = {"canvas": _get_image_bytes(canvas_size_px), "map": _get_image_bytes(map.size_px)}
+    if job.stream:
+        scale_y = map.raw_size_px[1] / float(map.size_px[1])
+        band_height = job.band_rows * Map.tile_size_px[1] + 2 * (int(3.0 * max(scale_y, 1.0)) + 2)
+        memory["raw_band"] = _get_image_bytes((map.raw_size_px[0], min(band_height, map.raw_size_px[1])))
+    else:
+        memory["raw"] = _get_image_bytes(map.raw_size_px)
+    memory["tiles"] = 2 * map.num_draw_workers * Map.draw_chunk_size * _get_image_bytes(Map.tile_size_px)
+    if location.heatmap:
+        # rgba layer and density grid (float64) of map size
+        memory["heatmap"] = _get_image_bytes(map.size_px, 4) + _get_image_bytes(map.size_px, 8)
+    memory["peak"] = sum(memory.values())
+
+    raw_mp = map.raw_size_px[0] * map.raw_size_px[1] / 1e6
+    seconds = {
+        "download_tiles": num_uncached * TileSeeder.default_latency / job.workers,
+        "draw": len(tiles) * stage_costs["draw"] / map.num_draw_workers,
+        "get_scaled": raw_mp * stage_costs["get_scaled"],
+        "save": canvas_size_px[0] * canvas_size_px[1] / 1e6 * stage_costs["save"],
+    }
+    seconds["total"] = sum(seconds.values())
+
+    plan = {
+        "zoom": map.zoom,
+        "tiles": len(tiles),
+        "uncached_tiles": num_uncached,
+        "missing_tiles": num_missing,
+        "download_bytes": int(num_uncached * tile_bytes),
+        "raw_size_px": list(map.raw_size_px),
+        "map_size_px": list(map.size_px),
+        "canvas_size_px": list(canvas_size_px),
+        "memory_bytes": memory,
+        "seconds": seconds,
+    }
+    plan["budget_errors"] = get_budget_errors(job, plan)
+    return plan
+
+def get_budget_errors(job, plan):
+    # exceeded budgets of a job
+    errors = []
+    if job.max_tiles is not None and plan["tiles"] > job.max_tiles:
+        errors.append(str(plan["tiles"]) + " tiles (max. " + str(job.max_tiles) + ")")
+    megabytes = plan["memory_bytes"]["peak"] / (1024.0 * 1024.0)
+    if job.max_memory_mb is not None and megabytes > job.max_memory_mb:
+        errors.append(str(round(megabytes)) + " MB memory (max. " + str(job.max_memory_mb) + " MB)")
+    megabytes = plan["download_bytes"] / (1024.0 * 1024.0)
+    if job.max_download_mb is not None and megabytes > job.max_download_mb:
+        errors.append(str(round(megabytes)) + " MB download (max. " + str(job.max_download_mb) + " MB)")
+    if job.max_seconds is not None and plan["seconds"]["total"] > job.max_seconds:
+        errors.append(str(round(plan["seconds"]["total"])) + " s (max. " + str(job.max_seconds) + " s)")
+    return errors
+
+def log_plan(plan):
+    megabytes = 1024.0 * 1024.0
+    logger.info("render plan:")
+    logger.info("   zoom level: " + str(plan["zoom"]))
+    logger.info("   tiles: " + str(plan["tiles"]) + " (" + str(plan["uncached_tiles"]) + " uncached, " +
+                str(plan["missing_tiles"]) + " missing)")
+    logger.info("   download: " + str(round(plan["download_bytes"] / megabytes, 1)) + " MB")
+    logger.info("   size raw: " + str(tuple(plan["raw_size_px"])) + " px, map: " + str(tuple(plan["map_size_px"])) +
+                " px, canvas: " + str(tuple(plan["canvas_size_px"])) + " px")
+    logger.info("   peak image memory: " + str(round(plan["memory_bytes"]["peak"] / megabytes)) + " MB (" +
+                ", ".join(name + " " + str(round(value / megabytes)) + " MB" for name, value in plan["memory_bytes"].items()
+                          if name != "peak") + ")")
+    logger.info("   estimated time: " + str(round(plan["seconds"]["total"], 1)) + " s (" +
+                ", ".join(name + " " + str(round(value, 1)) + " s" for name, value in plan["seconds"].items()
+                          if name != "total") + ")")
+    for error in plan["budget_errors"]:
+        logger.warning("   budget exceeded: " + error)
+
+def check_budgets(job, tile_provider=None):
+    # reject job if it exceeds its budgets (nothing to check if no budgets are set)
+    if job.max_tiles is None and job.max_memory_mb is None and job.max_download_mb is None and job.max_seconds is None:
+        return None
+    plan = plan_poster(job, tile_provider)
+    if plan["budget_errors"]:
+        raise PosterError("job exceeds budget: " + ", ".join(plan["budget_errors"]), 10)
+    return plan
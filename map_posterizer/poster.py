@@ -0,0 +1,312 @@
+import logging
+import os
+
+from map_posterizer.canvas import Canvas
+from map_posterizer.drawing_utils import configure_asset_cache
+from map_posterizer.heatmap import Heatmap
+from map_posterizer.map import Map
+from map_posterizer.metrics import Metrics
+from map_posterizer.overlay import Overlay
+from map_posterizer.places import configure_place_lookup
+from map_posterizer.planner import check_budgets
+from map_posterizer.poster_job import PosterError, PosterJob, create_tile_provider, load_poster_config, select_zoom
+from map_posterizer.pyramid import TilePyramid
+from map_posterizer.stage_cache import StageCache, get_file_signature, make_stage_key
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# poster pipeline
+# - PosterJob (poster_job.py) describes one poster (input files, resolution and render options)
+# - render_poster runs the full pipeline for a job (used by posterize.py and batch rendering)
+# - render_preview renders a low dpi preview from a coarse zoom level and optionally refines it step by step
+#   up to the final poster (the map region is the same at every step, so previews are framed like the poster)
+# - the stylized raw map and the scaled map are kept in a stage cache (keyed by a hash of their inputs), so
+#   re-renders with other captions, canvas styles or markers skip downloading, drawing and scaling the map
+
+def load_overlay(location):
+    # overlay tracks and markers of a location (None if there are none)
+    if not location.tracks and not location.markers:
+        return None
+    try:
+        return Overlay(location.tracks, location.markers)
+    except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+        raise PosterError("invalid overlay: " + str(e), 8)
+
+def load_heatmap(location):
+    # heatmap of a location (None if there is no heatmap file)
+    if not location.heatmap:
+        return None
+    try:
+        return Heatmap(location.heatmap)
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid heatmap: " + str(e), 8)
+
+def create_stage_cache(job):
+    # stage cache of a job (None if disabled)
+    if job.stage_cache_mb <= 0:
+        return None
+    try:
+        return StageCache("cache/stages/", job.stage_cache_mb)
+    except OSError as e:
+        logger.warning("stage cache disabled: " + str(e))
+        return None
+
+def _get_raw_map_inputs(job, location, canvas, map):
+    # all inputs of the stylized raw map (tiles, map region and style)
+    return {
+        "provider": map.map_tile_provider.provider["name"],
+        "archive": get_file_signature(job.tiles) if job.tiles is not None else None,
+        "zoom": map.zoom,
+        "top_left": location.top_left,
+        "bottom_right": location.bottom_right,
+        "dpi": job.dpi,
+        "content_size_mm": canvas.content_size_mm,
+        "style": map.style.get_style_hash(),
+    }
+
+def _get_map_inputs(job, location, canvas, map, marker):
+    # all inputs of the scaled map (raw map, overlay and marker)
+    style = map.style
+    inputs = _get_raw_map_inputs(job, location, canvas, map)
+    inputs.update({
+        "marker": marker,
+        "marker_style": [style.marker_style, style.marker_size_mm, style.marker_opacity],
+        "tracks": [get_file_signature(track) for track in location.tracks],
+        "markers": [get_file_signature(point) if isinstance(point, str) else point for point in location.markers],
+        "track_style": [style.track_color, style.track_width_mm, style.track_opacity],
+    })
+    return inputs
+
+def create_poster(job, tile_provider=None, verbose=True):
+    # create canvas and map of a job (no images are rendered yet)
+    location, canvas_style, map_style = load_poster_config(job)
+    if job.zoom is not None:
+        location.zoom = job.zoom
+    if verbose:
+        logger.info(location)
+
+    # create canvas
+    canvas = Canvas(canvas_style, job.dpi)
+    if verbose:
+        logger.info(canvas)
+
+    # select zoom level from output resolution
+    select_zoom(job, location, canvas.content_size_mm, verbose)
+
+    # create map
+    if tile_provider is None:
+        tile_provider = create_tile_provider(job, map_style)
+    map = Map(map_style, canvas.content_size_mm, job.dpi, location.top_left, location.bottom_right, location.zoom, job.workers, tile_provider)
+    if verbose:
+        logger.info(map)
+    return (location, canvas, map)
+
+def render_poster(job, tile_provider=None, metrics=None):
+    # run full pipeline for a job and save poster (stage timings, counters and sizes are recorded in metrics)
+    if job.preview or job.refine:
+        return render_preview(job, tile_provider, metrics)
+    if metrics is None:
+        metrics = Metrics()
+    job.validate()
+    # one tile provider for planning and rendering
+    if tile_provider is None:
+        tile_provider = create_tile_provider(job)
+    # reject jobs exceeding their budgets before anything is allocated or downloaded
+    with metrics.stage("plan"):
+        check_budgets(job, tile_provider)
+    configure_asset_cache("cache/assets/")
+    with metrics.stage("load"):
+        location, canvas, map = create_poster(job, tile_provider)
+        overlay = load_overlay(location)
+        if overlay is not None:
+            logger.info(overlay)
+        heatmap = load_heatmap(location)
+    metrics.set("zoom", map.zoom)
+    metrics.set("num_tiles", map.num_tiles[0] * map.num_tiles[1])
+    metrics.set("raw_size_px", list(map.raw_size_px))
+    metrics.set("map_size_px", list(map.size_px))
+    metrics.set("canvas_size_px", list(canvas.size_px))
+
+    try:
+        _render_poster_stages(job, location, canvas, map, overlay, heatmap, metrics)
+    finally:
+        # tile downloads and cache statistics
+        for name, value in map.map_tile_provider.get_stats().items():
+            metrics.add("tiles_" + name, value)
+        metrics.set("tile_hosts", map.map_tile_provider.get_host_stats())
+    metrics.set("output_bytes", os.path.getsize(job.output))
+    save_time = metrics.stages.get("save", 0.0)
+    logger.info("poster map saved to " + job.output + " (render " + str(round(metrics.get_elapsed() - save_time, 2)) +
+                " s, save " + str(round(save_time, 2)) + " s)")
+    return job.output
+
+def get_preview_filename(output, zoom):
+    # output file of a preview (e.g. map.preview-z13.png for map.png)
+    name, extension = os.path.splitext(output)
+    return name + ".preview-z" + str(zoom) + extension
+
+def render_preview(job, tile_provider=None, metrics=None):
+    # render preview at preview dpi from a coarse zoom level (zoom levels with cached tiles are preferred),
+    # refine: further previews with one more zoom level and twice the dpi each, then the final poster.
+    # each step is rendered as a poster job of its own (metrics of all steps are recorded in metrics)
+    if metrics is None:
+        metrics = Metrics()
+    job.validate()
+    location, canvas, map = create_poster(job, tile_provider, verbose=False)
+    tile_provider = map.map_tile_provider
+    # previews are rendered below the final zoom level (unless that is the coarsest preview zoom level already)
+    preview_dpi = min(job.preview_dpi, job.dpi)
+    max_preview_zoom = min(map.zoom, max(map.zoom - 1, Map.preview_min_zoom))
+    preview_zoom = Map.select_preview_zoom(canvas.content_size_mm, preview_dpi, location.top_left, location.bottom_right,
+                                           max_preview_zoom, tile_provider)
+
+    # steps: (zoom, dpi, output, final)
+    steps = [(preview_zoom, preview_dpi, get_preview_filename(job.output, preview_zoom), False)]
+    if job.refine:
+        for zoom in range(preview_zoom + 1, map.zoom):
+            dpi = min(preview_dpi * 2 ** (zoom - preview_zoom), job.dpi)
+            steps.append((zoom, dpi, get_preview_filename(job.output, zoom), False))
+        steps.append((map.zoom, job.dpi, job.output, True))
+
+    reports = []
+    output = None
+    for i, (zoom, dpi, output, final) in enumerate(steps):
+        logger.info("preview step " + str(i + 1) + " of " + str(len(steps)) + ": zoom " + str(zoom) + ", " + str(dpi) + " dpi")
+        step_job = PosterJob({option: getattr(job, option) for option in PosterJob.options})
+        step_job.zoom = zoom
+        step_job.dpi = dpi
+        step_job.output = output
+        step_job.preview = False
+        step_job.refine = False
+        # previews are encoded fast and never shown
+        step_job.fast = job.fast or not final
+        step_job.show = job.show and final
+        step_job.pyramid = job.pyramid if final else None
+        step_metrics = Metrics()
+        render_poster(step_job, tile_provider, step_metrics)
+        reports.append({"zoom": zoom, "dpi": dpi, "output": output, "metrics": step_metrics.get_report()})
+        metrics.set("steps", reports)
+    return output
+
+def _render_poster_stages(job, location, canvas, map, overlay, heatmap, metrics):
+    # marker location
+    marker = None
+    if not location.marker is None and not location.hide_marker:
+        marker = location.marker
+
+    stage_cache = create_stage_cache(job)
+    try:
+        _render_map(job, location, canvas, map, overlay, marker, stage_cache, metrics)
+    finally:
+        if stage_cache is not None:
+            for name, value in stage_cache.get_stats().items():
+                metrics.add("stage_cache_" + name, value)
+
+    # draw heatmap onto map
+    if heatmap is not None:
+        logger.info("drawing heatmap ... ")
+        with metrics.stage("draw_heatmap"):
+            try:
+                canvas.draw_map_layer(heatmap.render(map))
+            except (OSError, ValueError) as e:
+                raise PosterError("invalid heatmap: " + str(e), 8)
+        metrics.set("heatmap_points", heatmap.num_points)
+        logger.info(heatmap)
+    # draw text box onto canvas
+    if not location.caption1 == "":
+        if location.caption3 == "<location>":
+            try:
+                configure_place_lookup(gazetteer_file=job.gazetteer, online=not job.offline)
+            except (OSError, ValueError) as e:
+                raise PosterError("invalid gazetteer: " + str(e), 7)
+        with metrics.stage("draw_text_box"):
+            canvas.draw_text_box(location.caption1, location.caption2, location.caption3, location.caption4, location.get_marker_coords())
+
+    # save output canvas
+    with metrics.stage("save"):
+        try:
+            canvas.save(job.output, job.show, job.format, job.compress_level, job.quality, job.fast)
+        except (OSError, ValueError) as e:
+            raise PosterError("failed to save poster: " + str(e), 9)
+
+    # write tile pyramid of canvas (from the canvas in memory, band by band)
+    if job.pyramid is not None:
+        with metrics.stage("pyramid"):
+            try:
+                num_tiles = TilePyramid(job.pyramid, tile_format=job.pyramid_format, quality=job.quality).write(canvas.image)
+            except (OSError, ValueError) as e:
+                raise PosterError("failed to save tile pyramid: " + str(e), 9)
+        metrics.set("pyramid_tiles", num_tiles)
+        logger.info("tile pyramid saved to " + job.pyramid + " (" + str(num_tiles) + " tiles)")
+
+def _download_tiles(map, metrics):
+    # download all tile images
+    with metrics.stage("download_tiles"):
+        failed_tiles = map.download_tiles()
+    if failed_tiles:
+        metrics.add("tiles_failed", len(failed_tiles))
+        raise PosterError("failed to download " + str(len(failed_tiles)) + " map tiles!", 4)
+
+def _render_map(job, location, canvas, map, overlay, marker, stage_cache, metrics):
+    # draw (or load) map onto canvas
+    if stage_cache is not None:
+        with metrics.stage("stage_cache_get"):
+            map_key = make_stage_key("map", _get_map_inputs(job, location, canvas, map, marker))
+            image_scaled = stage_cache.get_image("map", map_key)
+        if image_scaled is not None:
+            logger.info("map loaded from stage cache")
+            canvas.draw_map(image_scaled)
+            return
+
+    if job.stream:
+        # draw, stylize, crop and scale map band-wise onto canvas
+        _download_tiles(map, metrics)
+        with metrics.stage("draw_map_bands"):
+            canvas.draw_map_bands(map, marker, job.band_rows, overlay)
+        image_scaled = None
+    else:
+        image_raw = None
+        if stage_cache is not None:
+            with metrics.stage("stage_cache_get"):
+                raw_key = make_stage_key("raw", _get_raw_map_inputs(job, location, canvas, map))
+                image_raw = stage_cache.get_image("raw", raw_key)
+        if image_raw is not None:
+            logger.info("stylized map loaded from stage cache")
+            map.image_raw = image_raw
+            map.is_stylized = True
+        else:
+            _download_tiles(map, metrics)
+            # draw map (tiles are stylized while drawing)
+            with metrics.stage("draw"):
+                map.draw(stylize=True)
+            # apply image style (if not done while drawing)
+            with metrics.stage("stylize"):
+                map.stylize()
+            if stage_cache is not None:
+                with metrics.stage("stage_cache_put"):
+                    stage_cache.put_image("raw", raw_key, map.image_raw)
+        # draw overlay tracks and markers
+        if overlay is not None:
+            with metrics.stage("draw_overlay"):
+                map.draw_overlay(overlay)
+        # draw location marker
+        if not marker is None:
+            with metrics.stage("draw_marker"):
+                map.draw_marker(marker)
+        # crop image to tl and br region
+        with metrics.stage("crop_to_coords"):
+            map.crop_to_coords()
+
+        # draw map onto canvas
+        with metrics.stage("get_scaled"):
+            image_scaled = map.get_scaled()
+            canvas.draw_map(image_scaled)
+        # raw map is not needed anymore
+        map.image_raw = None
+
+    if stage_cache is not None:
+        with metrics.stage("stage_cache_put"):
+            if image_scaled is None:
+                image_scaled = canvas.get_map()
+            stage_cache.put_image("map", map_key, image_scaled)
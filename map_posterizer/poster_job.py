@@ -0,0 +1,180 @@
+import json
+import logging
+import sqlite3
+
+from map_posterizer.canvas import CanvasStyle
+from map_posterizer.encoders import output_formats
+from map_posterizer.map import Map, MapLocation, MapStyle, MapTileProvider
+from map_posterizer.pyramid import tile_formats
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# poster jobs
+# - PosterJob describes one poster (input files, resolution and render options)
+# - loading of the job's location and styles, its tile provider and zoom level (shared by the poster pipeline,
+#   the render planner and tile seeding)
+
+class PosterError(Exception):
+    """Invalid poster job or render failure"""
+
+    def __init__(self, message, exit_code):
+        super().__init__(message)
+        # exit code of posterize.py
+        self.exit_code = exit_code
+
+
+class PosterJob:
+    """Poster job"""
+
+    options = ("location", "output", "dpi", "canvas_style", "map_style", "tiles", "stream", "band_rows", "workers", "show",
+               "gazetteer", "offline", "format", "compress_level", "quality", "fast", "zoom", "preview", "refine", "preview_dpi", "stage_cache_mb",
+               "max_tiles", "max_memory_mb", "max_download_mb", "max_seconds", "pyramid", "pyramid_format", "cache_styled")
+    # types of options (jobs are also loaded from batch manifests and the render server, None is allowed for optional ones)
+    int_options = ("dpi", "band_rows", "workers", "compress_level", "quality", "preview_dpi", "stage_cache_mb")
+    optional_int_options = ("zoom", "max_tiles")
+    optional_number_options = ("max_memory_mb", "max_download_mb", "max_seconds")
+    bool_options = ("stream", "show", "offline", "fast", "preview", "refine", "cache_styled")
+    str_options = ("location", "output", "canvas_style", "map_style", "pyramid_format")
+    optional_str_options = ("tiles", "gazetteer", "format", "pyramid")
+
+    def __init__(self, config):
+        self.load(config)
+
+    def load(self, config):
+        # default values
+        self.location = "location.json"
+        self.output = "map.png"
+        self.dpi = 300
+        self.canvas_style = "resources/canvas_style_dark.json"
+        self.map_style = "resources/map_style_light.json"
+        self.tiles = None
+        self.stream = False
+        self.band_rows = 4
+        self.workers = 8
+        self.show = False
+        self.gazetteer = None
+        self.offline = False
+        # output encoding (format from output file extension if None)
+        self.format = None
+        self.compress_level = 6
+        self.quality = 90
+        self.fast = False
+        # zoom level (overrides zoom level of location file if not None)
+        self.zoom = None
+        # preview (refine: render previews up to the final poster), resolution of first preview
+        self.preview = False
+        self.refine = False
+        self.preview_dpi = 72
+        # size of stage cache (0: no stage cache, only worth it for repeated renders of a poster)
+        self.stage_cache_mb = 0
+        # budgets (jobs whose estimates exceed a budget are rejected, None: no limit)
+        self.max_tiles = None
+        self.max_memory_mb = None
+        self.max_download_mb = None
+        self.max_seconds = None
+        # tile pyramid of poster (.dzi file or folder of xyz tiles, None: no pyramid) and format of its tiles
+        self.pyramid = None
+        self.pyramid_format = "png"
+        # keep stylized tiles in the tile cache (faster repeated renders, more disk space per map style)
+        self.cache_styled = False
+
+        # load values from dict
+        for option in PosterJob.options:
+            if option in config:
+                setattr(self, option, config[option])
+
+    def _validate_types(self):
+        for option in PosterJob.options:
+            value = getattr(self, option)
+            if option in PosterJob.optional_int_options + PosterJob.optional_number_options + PosterJob.optional_str_options and value is None:
+                continue
+            if option in PosterJob.int_options + PosterJob.optional_int_options:
+                valid = isinstance(value, int) and not isinstance(value, bool)
+            elif option in PosterJob.optional_number_options:
+                valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            elif option in PosterJob.bool_options:
+                valid = isinstance(value, bool)
+            else:
+                valid = isinstance(value, str)
+            if not valid:
+                raise PosterError("invalid value of option " + option + ": " + repr(value), 1)
+
+    def validate(self):
+        # validate option types, resolution and output filename
+        self._validate_types()
+        if self.dpi < 50 or self.dpi > 600:
+            raise PosterError("invalid dpi!", 1)
+        if self.output is None or self.output == "":
+            raise PosterError("invalid output filename!", 1)
+        if self.band_rows < 1:
+            raise PosterError("invalid number of band rows!", 1)
+        if self.workers < 1:
+            raise PosterError("invalid number of workers!", 1)
+        if self.format is not None and self.format not in output_formats.values():
+            raise PosterError("invalid output format!", 1)
+        if self.compress_level < 0 or self.compress_level > 9 or self.quality < 1 or self.quality > 100:
+            raise PosterError("invalid compression level or quality!", 1)
+        if self.zoom is not None and (self.zoom < Map.preview_min_zoom or self.zoom > MapLocation.max_zoom):
+            raise PosterError("invalid zoom level!", 1)
+        if (self.preview or self.refine) and self.preview_dpi < 20:
+            raise PosterError("invalid preview dpi!", 1)
+        if self.stage_cache_mb < 0:
+            raise PosterError("invalid stage cache size!", 1)
+        if self.pyramid_format not in tile_formats:
+            raise PosterError("invalid pyramid tile format!", 1)
+
+    def __str__(self):
+        return str(__class__.__name__) + ": " + str(self.location) + " -> " + str(self.output)
+
+
+def _load_json(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def load_map_style(job):
+    try:
+        return MapStyle(_load_json(job.map_style))
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid style files! (" + str(e) + ")", 3)
+
+def load_poster_config(job, require_zoom=True):
+    # load location, canvas and map styles of a job (require_zoom: location must have a zoom level)
+    try:
+        canvas_style = CanvasStyle(_load_json(job.canvas_style))
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid style files! (" + str(e) + ")", 3)
+    map_style = load_map_style(job)
+
+    try:
+        location = MapLocation(_load_json(job.location))
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid map location file! (" + str(e) + ")", 2)
+    if location.top_left is None or location.bottom_right is None or (require_zoom and location.zoom is None):
+        raise PosterError("invalid map location (coordinates and/or zoom)!", 2)
+    return (location, canvas_style, map_style)
+
+def create_tile_provider(job, map_style=None):
+    # tile provider of a job: local tile archive or tile provider of map style (loaded if not given)
+    if job.tiles is not None:
+        try:
+            return MapTileProvider(MapTileProvider.create_archive_provider(job.tiles), "cache/", False, job.workers)
+        except (ValueError, sqlite3.Error) as e:
+            raise PosterError("invalid tile archive: " + str(e), 5)
+    if map_style is None:
+        map_style = load_map_style(job)
+    return MapTileProvider(map_style.style, "cache/", True, job.workers, cache_styled=job.cache_styled)
+
+def select_zoom(job, location, content_size_mm, verbose=True):
+    # select zoom level of location from output resolution (if zoom level is "auto")
+    if location.zoom != "auto":
+        return location.zoom
+    candidates = Map.get_zoom_candidates(content_size_mm, job.dpi, location.top_left, location.bottom_right)
+    location.zoom = Map.select_zoom(content_size_mm, job.dpi, location.top_left, location.bottom_right, location.zoom_bias, candidates)
+    if verbose:
+        logger.info("zoom level candidates:")
+        for candidate in candidates:
+            logger.info("   zoom " + str(candidate["zoom"]) + ": " + str(candidate["raw_size_px"]) + " px raw, " +
+                        str(round(candidate["density"], 2)) + " px per output px, " + str(candidate["num_tiles"]) + " tiles" +
+                        (" (selected)" if candidate["zoom"] == location.zoom else ""))
+    return location.zoom
@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+
+from PIL import Image
+
+# --------------------------------------------------------------------
+# tile pyramid export
+# - the finished canvas is cut into tiles for all levels of a zoomable image (e.g. for OpenSeadragon or Leaflet)
+# - dzi layout: <name>.dzi descriptor and <name>_files/<level>/<column>_<row>.<format> (levels down to 1x1 px)
+# - xyz layout: <folder>/<z>/<x>/<y>.<format>, z = 0 is the most detailed level that fits into one tile,
+#   edge tiles are padded to full tiles (transparent, white for jpeg) as xyz viewers expect square tiles
+# - the canvas is read in bands of tile rows; whenever a level has a full row of tiles, the tiles are written
+#   and the rows are reduced by 2x for the next level, so every level only keeps one row of tiles in memory
+# useful literature
+# - deep zoom format: https://learn.microsoft.com/en-us/previous-versions/windows/silverlight/dotnet-windows-silverlight/cc645077(v=vs.95)
+
+tile_formats = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+
+class _PyramidLevel:
+    """Rows of one pyramid level"""
+
+    def __init__(self, pyramid, level, width, next_level):
+        self.pyramid = pyramid
+        self.level = level
+        self.width = width
+        self.next_level = next_level
+        # rows that don't fill a row of tiles yet and index of the next row of tiles
+        self.rows = None
+        self.tile_row = 0
+
+    def add_rows(self, rows):
+        if self.rows is None:
+            self.rows = rows
+        else:
+            combined = Image.new(rows.mode, (self.width, self.rows.size[1] + rows.size[1]))
+            combined.paste(self.rows, (0, 0))
+            combined.paste(rows, (0, self.rows.size[1]))
+            self.rows = combined
+        tile_size = self.pyramid.tile_size
+        while self.rows is not None and self.rows.size[1] >= tile_size:
+            row = self.rows.crop((0, 0, self.width, tile_size))
+            rest = self.rows.size[1] - tile_size
+            self.rows = self.rows.crop((0, tile_size, self.width, self.rows.size[1])) if rest > 0 else None
+            self._write_row(row)
+
+    def finish(self):
+        # write remaining rows (last row of tiles), then finish lower levels
+        if self.rows is not None:
+            self._write_row(self.rows)
+            self.rows = None
+        if self.next_level is not None:
+            self.next_level.finish()
+
+    def _write_row(self, row):
+        # write tiles of a row and pass reduced rows on to next level
+        tile_size = self.pyramid.tile_size
+        for column in range(int(math.ceil(self.width / float(tile_size)))):
+            tile = row.crop((column * tile_size, 0, min((column + 1) * tile_size, self.width), row.size[1]))
+            self.pyramid.write_tile(self.level, column, self.tile_row, tile)
+        self.tile_row += 1
+        if self.next_level is not None:
+            self.next_level.add_rows(row.reduce(2))
+
+
+class TilePyramid:
+    """Tile pyramid writer"""
+
+    def __init__(self, filename, tile_size=256, tile_format="png", quality=90, num_workers=None):
+        # filename: .dzi file (dzi layout) or folder (xyz layout)
+        self.filename = filename
+        self.layout = "dzi" if filename.lower().endswith(".dzi") else "xyz"
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.quality = quality
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.num_tiles = 0
+        self.futures = []
+        self.folders = set()
+
+    def get_levels(self, size):
+        # sizes of all levels (least detailed level first)
+        max_level = int(math.ceil(math.log2(max(size[0], size[1], 1))))
+        sizes = [(int(math.ceil(size[0] / 2.0 ** (max_level - level))), int(math.ceil(size[1] / 2.0 ** (max_level - level))))
+                 for level in range(max_level + 1)]
+        if self.layout == "xyz":
+            # levels from the most detailed one that fits into one tile
+            min_level = max([level for level in range(max_level + 1) if max(sizes[level]) <= self.tile_size] or [0])
+            return sizes[min_level:]
+        return sizes
+
+    def _get_tile_filename(self, level, column, row):
+        extension = "." + tile_formats[self.tile_format]
+        if self.layout == "dzi":
+            folder = os.path.join(os.path.splitext(self.filename)[0] + "_files", str(level))
+            name = str(column) + "_" + str(row) + extension
+        else:
+            folder = os.path.join(self.filename, str(level), str(column))
+            name = str(row) + extension
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            self.folders.add(folder)
+        return os.path.join(folder, name)
+
+    def _save_tile(self, tile, filename):
+        if self.tile_format == "png":
+            tile.save(filename, "PNG", compress_level=6)
+        elif self.tile_format == "jpeg":
+            tile.save(filename, "JPEG", quality=self.quality)
+        else:
+            tile.save(filename, "WEBP", quality=self.quality)
+
+    def _pad_tile(self, tile):
+        # full size tile with the tile image in its top left corner
+        if self.tile_format == "jpeg":
+            padded = Image.new("RGB", (self.tile_size, self.tile_size), (255, 255, 255))
+        else:
+            padded = Image.new("RGBA", (self.tile_size, self.tile_size), (0, 0, 0, 0))
+        padded.paste(tile, (0, 0))
+        return padded
+
+    def write_tile(self, level, column, row, tile):
+        # tiles are encoded by a pool of threads (number of tiles in flight is bounded)
+        if self.layout == "xyz" and tile.size != (self.tile_size, self.tile_size):
+            tile = self._pad_tile(tile)
+        filename = self._get_tile_filename(level, column, row)
+        self.futures.append(self.executor.submit(self._save_tile, tile, filename))
+        self.num_tiles += 1
+        while len(self.futures) > 4 * self.num_workers:
+            self.futures.pop(0).result()
+
+    def write(self, image, band_rows=1):
+        # write pyramid of image, read in bands of band_rows tile rows, returns number of tiles
+        if image.mode not in ("L", "RGB") and self.tile_format == "jpeg":
+            image = image.convert("RGB")
+        # chain of levels, starting with the most detailed one
+        levels = None
+        for level, size in enumerate(self.get_levels(image.size)):
+            levels = _PyramidLevel(self, level, size[0], levels)
+        if self.layout == "dzi":
+            self._write_descriptor(image.size)
+
+        band_height = band_rows * self.tile_size
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        with self.executor:
+            for y in range(0, image.size[1], band_height):
+                levels.add_rows(image.crop((0, y, image.size[0], min(y + band_height, image.size[1]))))
+            levels.finish()
+            for future in self.futures:
+                future.result()
+        self.futures = []
+        return self.num_tiles
+
+    def _write_descriptor(self, size):
+        folder = os.path.dirname(self.filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.filename, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="' + tile_formats[self.tile_format] +
+                    '" Overlap="0" TileSize="' + str(self.tile_size) + '">\n')
+            f.write('    <Size Width="' + str(size[0]) + '" Height="' + str(size[1]) + '"/>\n')
+            f.write('</Image>\n')
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from map_posterizer.geo_utils import degToCornerTiles
+from map_posterizer.map import Map, MapLocation, MapStyle, MapTileProvider
+from map_posterizer.poster_job import PosterError, load_poster_config
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# tile cache seeding
+# - tiles of a bounding box (or of the map of a location) are fetched into the tile cache for a range of zoom levels
+# - cached tiles are skipped (unless they are stale), the others are fetched by a pool of workers with a rate limit
+# - the tiles of each zoom level are processed in chunks, finished chunks are recorded in a manifest file,
+#   so an interrupted run continues where it stopped (the manifest is removed once all tiles are fetched)
+# - number of tiles, download size and time are estimated before seeding starts
+
+class RateLimiter:
+    """Request rate limiter (shared by threads)"""
+
+    def __init__(self, rate=None):
+        # rate: max. requests per second (None: no limit)
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval <= 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_bbox_tiles(corner_tl_deg, corner_br_deg, zoom):
+    # all tiles of a bounding box (row by row)
+    corner_tl_tile, corner_br_tile = degToCornerTiles(corner_tl_deg, corner_br_deg, zoom)
+    return [(x, y) for y in range(corner_tl_tile[1], corner_br_tile[1] + 1)
+                   for x in range(corner_tl_tile[0], corner_br_tile[0] + 1)]
+
+
+class TileSeeder:
+    """Tile cache seeder"""
+
+    # tiles per manifest entry
+    chunk_size = 256
+    # assumed tile size and latency for estimates (if no tiles of the provider are cached yet)
+    default_tile_bytes = 20000
+    default_latency = 0.15
+
+    def __init__(self, tile_provider, tiles, manifest_file, rate=None):
+        # tiles: dict zoom -> list of tiles
+        self.tile_provider = tile_provider
+        self.tiles = tiles
+        self.manifest_file = manifest_file
+        self.rate = rate
+        self.rate_limiter = RateLimiter(rate)
+        self.manifest = self._load_manifest()
+
+    def _get_chunks(self, zoom):
+        tiles = self.tiles[zoom]
+        return [tiles[i:i + TileSeeder.chunk_size] for i in range(0, len(tiles), TileSeeder.chunk_size)]
+
+    def _load_manifest(self):
+        # manifest of a previous run (finished chunks per zoom level), empty manifest if there is none
+        manifest = {"provider": self.tile_provider.provider["name"], "done": {}, "failed": []}
+        if self.manifest_file is not None and os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, "r") as f:
+                    manifest.update(json.load(f))
+                logger.info("resuming seeding from " + self.manifest_file)
+            except (OSError, ValueError) as e:
+                logger.warning("ignoring invalid seeding manifest: " + str(e))
+        return manifest
+
+    def _save_manifest(self):
+        if self.manifest_file is None:
+            return
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_file, self.manifest_file)
+
+    def _is_chunk_done(self, zoom, index):
+        return index in self.manifest["done"].get(str(zoom), [])
+
+    def get_pending_tiles(self, zoom):
+        # tiles of a zoom level that still have to be fetched (not in finished chunks, not cached)
+        pending = []
+        for index, chunk in enumerate(self._get_chunks(zoom)):
+            if not self._is_chunk_done(zoom, index):
+                pending.extend(tile for tile in chunk if not self.tile_provider.is_tile_fresh(zoom, tile[0], tile[1]))
+        return pending
+
+    def get_estimate(self):
+        # number of tiles, tiles to fetch, download size (bytes) and time (s)
+        num_tiles = sum(len(tiles) for tiles in self.tiles.values())
+        num_pending = sum(len(self.get_pending_tiles(zoom)) for zoom in self.tiles)
+        tile_bytes = self.tile_provider.get_average_tile_size() or TileSeeder.default_tile_bytes
+        seconds = num_pending * TileSeeder.default_latency / self.tile_provider.num_workers
+        if self.rate:
+            seconds = max(seconds, num_pending / self.rate)
+        return {"tiles": num_tiles, "pending": num_pending, "bytes": int(num_pending * tile_bytes), "seconds": seconds}
+
+    def _fetch_tile(self, zoom, tile):
+        self.rate_limiter.wait()
+        try:
+            return self.tile_provider.fetch_tile(zoom, tile[0], tile[1])
+        except Exception as e:
+            logger.warning("   tile download error: " + str(tile) + ": " + str(e))
+            return False
+
+    def run(self):
+        # fetch all pending tiles, returns statistics
+        stats = {"fetched": 0, "skipped": 0, "failed": 0}
+        failed = []
+        executor = ThreadPoolExecutor(max_workers=self.tile_provider.num_workers)
+        try:
+            for zoom in sorted(self.tiles):
+                chunks = self._get_chunks(zoom)
+                logger.info("seeding zoom " + str(zoom) + ": " + str(len(self.tiles[zoom])) + " tiles")
+                for index, chunk in enumerate(chunks):
+                    if self._is_chunk_done(zoom, index):
+                        stats["skipped"] += len(chunk)
+                        continue
+                    pending = [tile for tile in chunk if not self.tile_provider.is_tile_fresh(zoom, tile[0], tile[1])]
+                    stats["skipped"] += len(chunk) - len(pending)
+                    results = list(executor.map(lambda tile: self._fetch_tile(zoom, tile), pending))
+                    chunk_failed = [[zoom, tile[0], tile[1]] for tile, ok in zip(pending, results) if not ok]
+                    stats["fetched"] += len(pending) - len(chunk_failed)
+                    stats["failed"] += len(chunk_failed)
+                    failed.extend(chunk_failed)
+                    # chunks with failed tiles are fetched again by the next run
+                    if not chunk_failed:
+                        self.manifest["done"].setdefault(str(zoom), []).append(index)
+                    self.manifest["failed"] = failed
+                    self._save_manifest()
+                    logger.info("   chunk " + str(index + 1) + " of " + str(len(chunks)) + " (" + str(stats["fetched"]) +
+                                " fetched, " + str(stats["skipped"]) + " cached, " + str(stats["failed"]) + " failed)")
+        except KeyboardInterrupt:
+            # finished chunks are in the manifest already
+            logger.warning("seeding interrupted (run again to resume)")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown()
+        # manifest is only needed to resume unfinished runs
+        if not failed and self.manifest_file is not None and os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+        return stats
+
+
+def _get_location_tiles(job, zooms, tile_provider):
+    # tiles of the map of a location (map region as rendered with the canvas style of the job),
+    # the zoom levels are given, so the location needs no zoom level
+    location, canvas_style, map_style = load_poster_config(job, require_zoom=False)
+    content_size_mm = canvas_style.get_content_size_mm()
+    tiles = {}
+    for zoom in zooms:
+        map = Map(map_style, content_size_mm, job.dpi, location.top_left, location.bottom_right, zoom, tile_provider=tile_provider)
+        tiles[zoom] = map.get_tiles()
+    return tiles
+
+def seed_tiles(job, min_zoom, max_zoom, bbox=None, rate=None, manifest_file=None, dry_run=False):
+    # seed tile cache with tiles of a bounding box (lat, lon of top left and bottom right corner) or of the map of
+    # the job's location for zoom levels min_zoom..max_zoom, returns statistics (None for a dry run)
+    if job.tiles is not None:
+        raise PosterError("tiles of a tile archive need no seeding!", 1)
+    if min_zoom < 0 or max_zoom > MapLocation.max_zoom or min_zoom > max_zoom:
+        raise PosterError("invalid zoom range!", 1)
+    if rate is not None and rate <= 0.0:
+        raise PosterError("invalid rate limit!", 1)
+    try:
+        with open(job.map_style, "r") as f:
+            map_style = MapStyle(json.load(f))
+    except (OSError, ValueError) as e:
+        raise PosterError("invalid style files! (" + str(e) + ")", 3)
+    tile_provider = MapTileProvider(map_style.style, "cache/", True, job.workers)
+
+    zooms = range(min_zoom, max_zoom + 1)
+    if bbox is not None:
+        tiles = {zoom: get_bbox_tiles(bbox[0:2], bbox[2:4], zoom) for zoom in zooms}
+        region = list(bbox)
+    else:
+        tiles = _get_location_tiles(job, zooms, tile_provider)
+        region = [job.location, job.canvas_style, job.dpi]
+
+    # manifest file of this seeding run (same provider, region and zoom levels)
+    if manifest_file is None:
+        values = json.dumps([tile_provider.provider["name"], region, min_zoom, max_zoom])
+        manifest_file = os.path.join("cache", "seed_" + hashlib.sha1(values.encode("utf-8")).hexdigest()[:16] + ".json")
+    seeder = TileSeeder(tile_provider, tiles, manifest_file, rate)
+
+    estimate = seeder.get_estimate()
+    logger.info("seeding " + str(estimate["tiles"]) + " tiles of zoom levels " + str(min_zoom) + "-" + str(max_zoom) + ": " +
+                str(estimate["pending"]) + " to fetch, about " + str(round(estimate["bytes"] / (1024.0 * 1024.0), 1)) + " MB, " +
+                str(round(estimate["seconds"] / 60.0, 1)) + " min")
+    cache_bytes = tile_provider.cache.disk.max_bytes
+    if estimate["bytes"] + tile_provider.cache.disk.total_bytes > cache_bytes:
+        logger.warning("tiles exceed the size of the tile cache (" + str(cache_bytes // (1024 * 1024)) + " MB), "
+                       "least recently used tiles will be evicted!")
+    if dry_run:
+        return None
+
+    start = time.time()
+    stats = seeder.run()
+    logger.info("seeding done in " + str(round(time.time() - start, 1)) + " s: " + str(stats["fetched"]) + " fetched, " +
+                str(stats["skipped"]) + " cached, " + str(stats["failed"]) + " failed")
+    return stats
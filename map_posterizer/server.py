@@ -0,0 +1,307 @@
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+from map_posterizer.encoders import get_output_format
+from map_posterizer.map import MapStyle, MapTileProvider
+from map_posterizer.metrics import Metrics
+from map_posterizer.poster import PosterError, PosterJob, create_tile_provider, render_poster
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# render server
+# - long-running process that renders poster jobs posted to a local http api (tcp or unix socket)
+# - modules, fonts, marker sprites, tile providers (connection pools, memory tile caches) and
+#   place lookups stay loaded between jobs
+# - jobs are queued (bounded, requests are rejected with 503 if the queue is full) and rendered
+#   by a pool of worker threads, the status and timings of each job can be queried
+#
+# api:
+#   POST /jobs               render job (json object with poster job options), returns job status (202)
+#   GET  /jobs               status of all jobs
+#   GET  /jobs/<id>          status of a job (state: queued, running, done or failed)
+#   GET  /jobs/<id>/output   rendered poster (once the job is done)
+#   GET  /status             queue, workers and tile statistics
+
+content_types = {"png": "image/png", "tiff": "image/tiff", "jpeg": "image/jpeg", "webp": "image/webp", "pdf": "application/pdf"}
+
+
+class RenderService:
+    """Render job queue with a pool of worker threads"""
+
+    # number of finished jobs whose status is kept
+    max_finished_jobs = 1000
+
+    def __init__(self, defaults, num_workers=2, queue_size=16):
+        # defaults: poster job options for values not set by a job
+        self.defaults = dict(defaults)
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self.providers = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.num_rejected = 0
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name="render-" + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        # workers finish running jobs, queued jobs are dropped (the queue may be full, so stop markers are put
+        # into the drained queue)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                with self.lock:
+                    status = self.jobs[item[0]]
+                    status["state"] = "failed"
+                    status["error"] = "render server stopped"
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, config):
+        # queue a job, returns its status (raises PosterError for invalid jobs, queue.Full if the queue is full)
+        job_config = dict(self.defaults)
+        job_config.update(config)
+        job = PosterJob(job_config)
+        job.validate()
+        job.show = False
+        job_id = uuid.uuid4().hex[:16]
+        status = {
+            "id": job_id,
+            "state": "queued",
+            "output": job.output,
+            "error": None,
+            "exit_code": None,
+            "submitted": time.time(),
+            "queue_time": None,
+            "render_time": None,
+            "metrics": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = status
+            try:
+                self.queue.put_nowait((job_id, job))
+            except queue.Full:
+                del self.jobs[job_id]
+                self.num_rejected += 1
+                raise
+            return dict(status)
+
+    def get_job(self, job_id):
+        with self.lock:
+            status = self.jobs.get(job_id)
+            return dict(status) if status is not None else None
+
+    def get_jobs(self):
+        with self.lock:
+            return [dict(status) for status in self.jobs.values()]
+
+    def get_status(self):
+        with self.lock:
+            states = [status["state"] for status in self.jobs.values()]
+            providers = dict(self.providers)
+        return {
+            "workers": self.num_workers,
+            "queue_size": self.queue.maxsize,
+            "rejected": self.num_rejected,
+            "jobs": {state: states.count(state) for state in ("queued", "running", "done", "failed")},
+            "tiles": {name: provider.get_stats() for name, provider in providers.items()},
+        }
+
+    def _get_tile_provider(self, job):
+        # shared tile provider of a job (tile archive or provider of map style), None if it cannot be created
+        # (the error is reported by render_poster then)
+        try:
+            key = job.tiles
+            if key is None:
+                with open(job.map_style, "r") as f:
+                    style = MapStyle(json.load(f)).style
+                # providers with and without cache for stylized tiles
+                key = style + ("@styled" if job.cache_styled else "")
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            provider = self.providers.get(key)
+            if provider is None:
+                if job.tiles is not None:
+                    provider = create_tile_provider(job)
+                else:
+                    provider = MapTileProvider(style, "cache/", True, job.workers, cache_styled=job.cache_styled)
+                self.providers[key] = provider
+            return provider
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._run_job(*item)
+
+    def _run_job(self, job_id, job):
+        start = time.time()
+        with self.lock:
+            status = self.jobs[job_id]
+            status["state"] = "running"
+            status["queue_time"] = start - status["submitted"]
+        logger.info("job " + job_id + " started: " + str(job))
+        metrics = Metrics()
+        state, error, exit_code, output = "failed", None, None, job.output
+        try:
+            # output of previews differs from job output
+            output = render_poster(job, self._get_tile_provider(job), metrics)
+            state = "done"
+        except PosterError as e:
+            error, exit_code = str(e), e.exit_code
+        except Exception as e:
+            error = type(e).__name__ + ": " + str(e)
+        with self.lock:
+            status["state"] = state
+            status["output"] = output
+            status["error"] = error
+            status["exit_code"] = exit_code
+            status["render_time"] = time.time() - start
+            status["metrics"] = metrics.get_report()
+            # forget oldest finished jobs
+            finished = [key for key, value in self.jobs.items() if value["state"] in ("done", "failed")]
+            for key in finished[:max(0, len(finished) - RenderService.max_finished_jobs)]:
+                del self.jobs[key]
+        logger.info("job " + job_id + " " + state + " (" + str(round(time.time() - start, 2)) + " s)" +
+                    (": " + error if error is not None else ""))
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """Render api request handler"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, code, value, headers=()):
+        data = json.dumps(value).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, header in headers:
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_output(self, status):
+        if status["state"] != "done":
+            self._send_json(409, {"error": "job is " + status["state"]})
+            return
+        try:
+            with open(status["output"], "rb") as f:
+                data = f.read()
+        except OSError as e:
+            self._send_json(404, {"error": str(e)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_types.get(get_output_format(status["output"]), "application/octet-stream"))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if parts == ["status"]:
+            self._send_json(200, service.get_status())
+        elif parts == ["jobs"]:
+            self._send_json(200, {"jobs": service.get_jobs()})
+        elif len(parts) in (2, 3) and parts[0] == "jobs" and parts[2:] in ([], ["output"]):
+            status = service.get_job(parts[1])
+            if status is None:
+                self._send_json(404, {"error": "unknown job"})
+            elif len(parts) == 3:
+                self._send_output(status)
+            else:
+                self._send_json(200, status)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            config = json.loads(self.rfile.read(length).decode("utf-8")) if length > 0 else {}
+            if not isinstance(config, dict):
+                raise ValueError("job must be a json object")
+        except ValueError as e:
+            self._send_json(400, {"error": "invalid job: " + str(e)})
+            return
+        try:
+            status = self.server.service.submit(config)
+        except (PosterError, TypeError, ValueError) as e:
+            self._send_json(400, {"error": "invalid job: " + str(e)})
+            return
+        except queue.Full:
+            # back-pressure: client should retry later
+            self._send_json(503, {"error": "render queue is full"}, [("Retry-After", "5")])
+            return
+        self._send_json(202, status, [("Location", "/jobs/" + status["id"])])
+
+    def log_message(self, format, *args):
+        logger.debug("request: " + (format % args))
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """HTTP server on a unix socket"""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # no host name lookup as in HTTPServer.server_bind
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def create_server(address, service):
+    # http server for address "host:port" or "unix:<socket file>"
+    if address.startswith("unix:"):
+        socket_file = address[len("unix:"):]
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        server = UnixHTTPServer(socket_file, RenderRequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), RenderRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+def serve(address, defaults, num_workers=2, queue_size=16):
+    # run render server until interrupted
+    service = RenderService(defaults, num_workers, queue_size).start()
+    server = create_server(address, service)
+    logger.info("render server listening on " + address + " (" + str(num_workers) + " workers, queue size " + str(queue_size) + ")")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("render server stopping ...")
+    finally:
+        server.server_close()
+        service.stop()
+        if address.startswith("unix:") and os.path.exists(address[len("unix:"):]):
+            os.remove(address[len("unix:"):])
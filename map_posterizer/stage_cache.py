@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from PIL import Image
+
+from map_posterizer.encoders import ParallelPngEncoder
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# stage cache
+# - images produced by pipeline stages (e.g. the stylized raw map, the scaled map) are stored under a hash
+#   of all inputs of the stage (content-addressed), re-renders only recompute stages whose inputs changed
+# - images are stored losslessly as png files in one folder (fast compression)
+# - the folder is bounded by total size, least recently used files are evicted (file access updates mtime)
+
+# changes of the pipeline that change stage outputs must increase the version (invalidates all entries)
+stage_cache_version = 1
+
+def get_file_signature(filename):
+    # identifies the content of an input file without reading it (path, size and modification time)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return [filename, None, None]
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+def make_stage_key(stage, inputs):
+    # hash of stage name and inputs (json-serializable values)
+    values = {"stage": stage, "version": stage_cache_version, "inputs": inputs}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=list).encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """Content-addressed cache of pipeline stage images"""
+
+    def __init__(self, folder, max_size_mb=1024):
+        self.folder = folder
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(folder, exist_ok=True)
+
+    def _get_filename(self, stage, key):
+        return os.path.join(self.folder, stage + "_" + key + ".png")
+
+    def get_image(self, stage, key):
+        # cached image of a stage (None if not cached)
+        filename = self._get_filename(stage, key)
+        try:
+            with Image.open(filename) as image:
+                image.load()
+            # mark as recently used
+            os.utime(filename)
+        except (OSError, ValueError):
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        return image
+
+    def put_image(self, stage, key, image):
+        # store image of a stage (images that would take up more than half of the cache are not stored)
+        if image.size[0] * image.size[1] * len(image.getbands()) > self.max_size // 2:
+            return False
+        filename = self._get_filename(stage, key)
+        temp_filename = filename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        try:
+            ParallelPngEncoder(compress_level=1).save(image, temp_filename)
+            os.replace(temp_filename, filename)
+        except OSError as e:
+            logger.warning("   failed to store " + stage + " in stage cache: " + str(e))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+        with self.lock:
+            self.stats["stores"] += 1
+        self.evict()
+        return True
+
+    def evict(self):
+        # remove least recently used files until the cache fits into its size
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".png"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(entry[1] for entry in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                # removed by another process
+                pass
+            total_size -= size
+            with self.lock:
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
@@ -0,0 +1,382 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+from io import BytesIO
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------
+# tile caches
+# - tiles are identified by keys (provider, zoom, tile_x, tile_y)
+# - MemoryTileCache keeps decoded tile images (LRU, bounded by number of tiles)
+# - DiskTileCache keeps the downloaded tile bytes in one indexed sqlite file
+#   (bounded by size in bytes, LRU eviction, TTL for revalidation/expiry)
+# - tile bytes are stored once per content (blobs addressed by sha1 hash, with reference counts), tiles refer
+#   to their blob: identical tiles (e.g. blank ocean or park tiles) take disk space once
+# - TileCache combines both and is used by MapTileProvider, decoded images are kept per content hash,
+#   so identical tiles are decoded once and share one image
+
+class MemoryTileCache:
+    """In-process LRU cache of decoded tile images"""
+
+    def __init__(self, max_tiles=512):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self.lock:
+            tile_image = self.tiles.get(key)
+            if tile_image is None:
+                self.stats["misses"] += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.stats["hits"] += 1
+            return tile_image
+
+    def put(self, key, tile_image):
+        if self.max_tiles <= 0:
+            return
+        with self.lock:
+            self.tiles[key] = tile_image
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        with self.lock:
+            self.tiles.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+
+
+def get_content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class DiskTileRecord:
+    """Cached tile bytes and http validators"""
+
+    def __init__(self, data, etag, last_modified, fetched, content_hash=None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.content_hash = content_hash
+
+
+class DiskTileCache:
+    """Size-bounded on-disk tile store with an sqlite index"""
+
+    # access times are only written back if they changed by more than this (seconds)
+    access_resolution = 600
+    # version of the database schema (1: tile bytes in blobs table, deduplicated by content hash)
+    schema_version = 1
+    # seconds to wait for writes of other processes sharing the cache
+    busy_timeout = 30.0
+    # the size of the cache is read from the database every this many puts (other processes may write too)
+    size_check_interval = 64
+
+    def __init__(self, folder, max_bytes=2 * 1024 ** 3, ttl=30 * 24 * 3600, max_age=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # bytes on disk (each blob counts once)
+        self.total_bytes = 0
+        self.num_puts = 0
+
+        os.makedirs(folder, exist_ok=True)
+        self.filename = os.path.join(folder, "tiles.sqlite")
+        self.db = sqlite3.connect(self.filename, timeout=DiskTileCache.busy_timeout, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        migrated = False
+        with self._transaction():
+            # checked within the transaction, another process may have created or migrated the tables meanwhile
+            if self.db.execute("PRAGMA user_version").fetchone()[0] == 0:
+                if self.db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tiles'").fetchone() is not None:
+                    self._migrate_v0()
+                    migrated = True
+                else:
+                    self._create_tables()
+            # sum of sizes without reading the blobs
+            self.db.execute("CREATE INDEX IF NOT EXISTS blobs_size ON blobs (size)")
+        if migrated:
+            # reclaim space of duplicate tiles
+            self.db.execute("VACUUM")
+        self.evict()
+
+    @contextmanager
+    def _transaction(self):
+        # write transaction (waits for writers of other processes), rolled back on errors
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            if self.db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='blobs'").fetchone() is not None:
+                self.total_bytes = self._read_total_bytes()
+            raise
+
+    def _read_total_bytes(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _touch(self, key, now):
+        # update access time (best effort, skipped if the database is busy)
+        try:
+            self.db.execute("UPDATE tiles SET accessed=? WHERE provider=? AND zoom=? AND x=? AND y=?", (now,) + key)
+        except sqlite3.OperationalError as e:
+            logger.debug("tile access time not updated: " + str(e))
+
+    def _create_tables(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                        "hash TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, refcount INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tiles ("
+                        "provider TEXT NOT NULL, zoom INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, "
+                        "hash TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                        "fetched REAL NOT NULL, accessed REAL NOT NULL, "
+                        "PRIMARY KEY (provider, zoom, x, y))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+        self.db.execute("PRAGMA user_version=" + str(DiskTileCache.schema_version))
+
+    def _migrate_v0(self):
+        # move tile bytes of a cache without blobs table (version 0) into deduplicated blobs
+        logger.info("migrating tile cache " + self.filename + " ...")
+        self.db.execute("ALTER TABLE tiles RENAME TO tiles_v0")
+        self.db.execute("DROP INDEX IF EXISTS tiles_accessed")
+        self._create_tables()
+        rows = self.db.execute("SELECT provider, zoom, x, y, data, etag, last_modified, fetched, accessed FROM tiles_v0")
+        num_tiles = 0
+        while True:
+            batch = rows.fetchmany(256)
+            if not batch:
+                break
+            for row in batch:
+                content_hash = self._add_blob(row[4])
+                self.db.execute("INSERT INTO tiles (provider, zoom, x, y, hash, etag, last_modified, fetched, accessed) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row[0:4] + (content_hash,) + row[5:9])
+            num_tiles += len(batch)
+        self.db.execute("DROP TABLE tiles_v0")
+        num_blobs = self.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        logger.info("   " + str(num_tiles) + " tiles, " + str(num_blobs) + " distinct")
+
+    def _add_blob(self, data):
+        # add reference to blob (blob is inserted if it's new), returns content hash
+        content_hash = get_content_hash(data)
+        cursor = self.db.execute("UPDATE blobs SET refcount = refcount + 1 WHERE hash=?", (content_hash,))
+        if cursor.rowcount == 0:
+            self.db.execute("INSERT INTO blobs (hash, data, size, refcount) VALUES (?, ?, ?, 1)", (content_hash, data, len(data)))
+            self.total_bytes += len(data)
+        return content_hash
+
+    def _release_blob(self, content_hash):
+        # remove reference to blob (blob is deleted if it isn't referenced anymore), returns freed bytes
+        self.db.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash=?", (content_hash,))
+        row = self.db.execute("SELECT size FROM blobs WHERE hash=? AND refcount <= 0", (content_hash,)).fetchone()
+        if row is None:
+            return 0
+        self.db.execute("DELETE FROM blobs WHERE hash=?", (content_hash,))
+        self.total_bytes -= row[0]
+        return row[0]
+
+    def _delete_tile(self, key, content_hash):
+        self.db.execute("DELETE FROM tiles WHERE provider=? AND zoom=? AND x=? AND y=?", key)
+        return self._release_blob(content_hash)
+
+    def contains(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM tiles WHERE provider=? AND zoom=? AND x=? AND y=?", key).fetchone()
+        return row is not None
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT blobs.data, etag, last_modified, fetched, accessed, tiles.hash FROM tiles "
+                                  "JOIN blobs ON blobs.hash = tiles.hash "
+                                  "WHERE provider=? AND zoom=? AND x=? AND y=?", key).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            if now - row[4] > DiskTileCache.access_resolution:
+                self._touch(key, now)
+        return DiskTileRecord(row[0], row[1], row[2], row[3], row[5])
+
+    def get_hash(self, key):
+        # content hash of a tile (None if not cached), counts as cache access
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT hash, accessed FROM tiles WHERE provider=? AND zoom=? AND x=? AND y=?", key).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            if now - row[1] > DiskTileCache.access_resolution:
+                self._touch(key, now)
+        return row[0]
+
+    def get_blob(self, content_hash):
+        # tile bytes of a content hash (None if there is no such blob)
+        with self.lock:
+            row = self.db.execute("SELECT data FROM blobs WHERE hash=?", (content_hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_info(self, key):
+        # tile validators without data (doesn't count as cache access)
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, fetched, hash FROM tiles "
+                                  "WHERE provider=? AND zoom=? AND x=? AND y=?", key).fetchone()
+        if row is None:
+            return None
+        return DiskTileRecord(None, row[0], row[1], row[2], row[3])
+
+    def is_stale(self, record):
+        return self.ttl is not None and time.time() - record.fetched > self.ttl
+
+    def get_average_size(self, provider):
+        # average size of the cached tiles of a provider in bytes (None if there are none)
+        with self.lock:
+            return self.db.execute("SELECT AVG(size) FROM tiles JOIN blobs ON blobs.hash = tiles.hash WHERE provider=?",
+                                   (provider,)).fetchone()[0]
+
+    def put(self, key, data, etag=None, last_modified=None):
+        # store tile, returns its content hash
+        now = time.time()
+        with self.lock:
+            with self._transaction():
+                row = self.db.execute("SELECT hash FROM tiles WHERE provider=? AND zoom=? AND x=? AND y=?", key).fetchone()
+                content_hash = self._add_blob(data)
+                self.db.execute("INSERT OR REPLACE INTO tiles (provider, zoom, x, y, hash, etag, last_modified, fetched, accessed) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", key + (content_hash, etag, last_modified, now, now))
+                if row is not None:
+                    self._release_blob(row[0])
+            self.num_puts += 1
+            if self.num_puts % DiskTileCache.size_check_interval == 0:
+                self.total_bytes = self._read_total_bytes()
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return content_hash
+
+    def remove_variants(self, key):
+        # remove tiles at the same location of providers named "<provider>@..." (e.g. stylized tiles)
+        with self.lock:
+            with self._transaction():
+                rows = self.db.execute("SELECT provider, hash FROM tiles WHERE provider > ? AND provider < ? AND zoom=? AND x=? AND y=?",
+                                       (key[0] + "@", key[0] + "A") + key[1:]).fetchall()
+                for row in rows:
+                    self._delete_tile((row[0],) + key[1:], row[1])
+
+    def refresh(self, key):
+        # mark tile as fresh again (after successful revalidation)
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE tiles SET fetched=?, accessed=? WHERE provider=? AND zoom=? AND x=? AND y=?", (now, now) + key)
+
+    def evict(self):
+        # drop expired tiles, then least recently used tiles until 90% of the size limit is reached
+        # (bytes are freed once the last tile referring to a blob is dropped)
+        with self.lock:
+            with self._transaction():
+                # size of the cache including tiles written by other processes
+                self.total_bytes = self._read_total_bytes()
+                if self.max_age is not None:
+                    rows = self.db.execute("SELECT provider, zoom, x, y, hash FROM tiles WHERE fetched < ?",
+                                           (time.time() - self.max_age,)).fetchall()
+                    for row in rows:
+                        self._delete_tile(row[:4], row[4])
+                    self.stats["evictions"] += len(rows)
+                target_bytes = int(self.max_bytes * 0.9)
+                while self.total_bytes > target_bytes:
+                    rows = self.db.execute("SELECT provider, zoom, x, y, hash FROM tiles ORDER BY accessed LIMIT 256").fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        self._delete_tile(row[:4], row[4])
+                        self.stats["evictions"] += 1
+                        if self.total_bytes <= target_bytes:
+                            break
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class TileCache:
+    """Tiered tile cache (memory LRU of decoded tiles in front of the disk store)"""
+
+    def __init__(self, folder, max_memory_tiles=512, max_disk_bytes=2 * 1024 ** 3, ttl=30 * 24 * 3600, max_age=None):
+        # decoded images by content hash (shared by all tiles with the same content)
+        self.memory = MemoryTileCache(max_memory_tiles)
+        self.disk = DiskTileCache(folder, max_disk_bytes, ttl, max_age)
+
+    def contains(self, key):
+        return self.disk.contains(key)
+
+    def get_info(self, key):
+        return self.disk.get_info(key)
+
+    def get_hash(self, key):
+        return self.disk.get_hash(key)
+
+    def is_stale(self, record):
+        return self.disk.is_stale(record)
+
+    def get_average_size(self, provider):
+        return self.disk.get_average_size(provider)
+
+    def get_image(self, key):
+        # decoded tile (None if not cached)
+        content_hash = self.disk.get_hash(key)
+        return self.get_image_by_hash(content_hash) if content_hash is not None else None
+
+    def get_image_by_hash(self, content_hash):
+        # decoded tile content from memory, falls back to decoding the blob from disk
+        tile_image = self.memory.get(content_hash)
+        if tile_image is not None:
+            return tile_image
+        data = self.disk.get_blob(content_hash)
+        if data is None:
+            return None
+        try:
+            tile_image = Image.open(BytesIO(data))
+            tile_image.load()
+        except (OSError, SyntaxError) as e:
+            logger.warning("Invalid cached tile " + content_hash + ": " + str(e))
+            return None
+        self.memory.put(content_hash, tile_image)
+        return tile_image
+
+    def put(self, key, data, etag=None, last_modified=None, tile_image=None):
+        # decoded images are keyed by content, so they never need to be invalidated
+        content_hash = self.disk.put(key, data, etag, last_modified)
+        if tile_image is not None:
+            self.memory.put(content_hash, tile_image)
+        return content_hash
+
+    def remove_variants(self, key):
+        self.disk.remove_variants(key)
+
+    def refresh(self, key):
+        self.disk.refresh(key)
+
+    def get_stats(self):
+        stats = {}
+        for level, cache in (("memory", self.memory), ("disk", self.disk)):
+            for name, value in cache.stats.items():
+                stats[level + "_" + name] = value
+        stats["disk_bytes"] = self.disk.total_bytes
+        return stats
@@ -0,0 +1,113 @@
+from collections import deque
+import threading
+import time
+
+# --------------------------------------------------------------------
+# tile server hosts
+# - a provider lists one or more url templates ("url" and "mirrors"), "{s}" in a template is replaced
+#   by each of the provider's "subdomains", every resulting url template is a host
+# - tiles are spread over the hosts (the same tile is always requested from the same host first),
+#   hosts that fail repeatedly are skipped for a while (failover to the other hosts)
+# - per-host statistics: requests, errors, hedged requests and recent latencies (for hedging percentiles)
+
+class TileHost:
+    """Tile server host"""
+
+    # number of recent latencies kept
+    num_latencies = 256
+
+    def __init__(self, url):
+        self.url = url
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_hedged = 0
+        self.consecutive_errors = 0
+        self.down_until = 0.0
+        self.latencies = deque(maxlen=TileHost.num_latencies)
+
+    def get_url(self, zoom, tile_x, tile_y):
+        return self.url.format(zoom, tile_x, tile_y)
+
+    def get_stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "requests": self.num_requests,
+            "errors": self.num_errors,
+            "hedged": self.num_hedged,
+            "latency_p50": _percentile(latencies, 50.0),
+            "latency_p95": _percentile(latencies, 95.0),
+            "available": time.time() >= self.down_until,
+        }
+
+
+def _percentile(values, percentile):
+    # percentile of sorted values (None if empty)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percentile / 100.0 * (len(values) - 1))))]
+
+
+class TileHostPool:
+    """Tile server hosts of a provider"""
+
+    # a host is skipped after this many errors in a row (for down_time seconds, doubled on each further error)
+    max_consecutive_errors = 3
+    down_time = 15.0
+    max_down_time = 300.0
+    # number of latency samples required before requests are hedged
+    min_hedge_samples = 20
+
+    def __init__(self, provider):
+        templates = [provider["url"]] + list(provider.get("mirrors", []))
+        subdomains = provider.get("subdomains", [])
+        self.hosts = []
+        for template in templates:
+            if "{s}" in template and subdomains:
+                self.hosts.extend(TileHost(template.replace("{s}", subdomain)) for subdomain in subdomains)
+            else:
+                self.hosts.append(TileHost(template.replace("{s}", "")))
+        # latency percentile after which a duplicate request is sent to another host (None: no hedging)
+        self.hedge_percentile = provider.get("hedge_percentile")
+        self.lock = threading.Lock()
+
+    def get_hosts(self, tile_x, tile_y):
+        # hosts in the order they should be tried for a tile (available hosts first)
+        now = time.time()
+        n = len(self.hosts)
+        start = (tile_x + tile_y) % n
+        hosts = [self.hosts[(start + i) % n] for i in range(n)]
+        return [host for host in hosts if now >= host.down_until] + [host for host in hosts if now < host.down_until]
+
+    def record_success(self, host, latency):
+        with self.lock:
+            host.num_requests += 1
+            host.consecutive_errors = 0
+            host.down_until = 0.0
+            host.latencies.append(latency)
+
+    def record_error(self, host):
+        with self.lock:
+            host.num_requests += 1
+            host.num_errors += 1
+            host.consecutive_errors += 1
+            if host.consecutive_errors >= TileHostPool.max_consecutive_errors:
+                num_down = host.consecutive_errors - TileHostPool.max_consecutive_errors
+                host.down_until = time.time() + min(TileHostPool.down_time * 2 ** num_down, TileHostPool.max_down_time)
+
+    def record_hedge(self, host):
+        with self.lock:
+            host.num_hedged += 1
+
+    def get_hedge_delay(self):
+        # time after which a request is hedged (None if hedging is disabled or there are not enough samples yet)
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            latencies = sorted(latency for host in self.hosts for latency in host.latencies)
+        if len(latencies) < TileHostPool.min_hedge_samples:
+            return None
+        return _percentile(latencies, self.hedge_percentile)
+
+    def get_stats(self):
+        with self.lock:
+            return {host.url: host.get_stats() for host in self.hosts}
@@ -0,0 +1,227 @@
+import gzip
+import os
+import sqlite3
+import struct
+import threading
+
+# --------------------------------------------------------------------
+# local tile archives
+# - MBTiles: sqlite database with tiles in TMS order (y axis flipped)
+#   https://github.com/mapbox/mbtiles-spec
+# - PMTiles (v3): single file with hilbert-ordered tile directories
+#   https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+# both sources support batched lookups for a whole range of tiles
+
+def open_tile_archive(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".mbtiles":
+        return MBTilesSource(filename)
+    if ext == ".pmtiles":
+        return PMTilesSource(filename)
+    raise ValueError("unsupported tile archive: " + filename)
+
+
+class MBTilesSource:
+    """Raster tiles from an MBTiles (sqlite) archive"""
+
+    # max. number of tiles per query (sqlite variable limit)
+    batch_size = 400
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise ValueError("tile archive does not exist: " + filename)
+        self.filename = filename
+        self.db = sqlite3.connect("file:" + filename + "?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.metadata = dict(self.db.execute("SELECT name, value FROM metadata").fetchall())
+        if self.metadata.get("format", "png") not in ("png", "jpg", "jpeg", "webp"):
+            raise ValueError("unsupported tile format in " + filename + ": " + self.metadata["format"])
+
+    def _query(self, zoom, tiles, columns):
+        # query tiles in batches, rows are converted from TMS to XYZ
+        n = 2 ** zoom
+        tiles = list(tiles)
+        results = {}
+        for i in range(0, len(tiles), MBTilesSource.batch_size):
+            batch = tiles[i:i + MBTilesSource.batch_size]
+            xs = [t[0] for t in batch]
+            ys = [n - 1 - t[1] for t in batch]
+            wanted = set((x, n - 1 - y) for (x, y) in batch)
+            with self.lock:
+                rows = self.db.execute("SELECT tile_column, tile_row" + columns + " FROM tiles "
+                                       "WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                                       (zoom, min(xs), max(xs), min(ys), max(ys))).fetchall()
+            for row in rows:
+                if (row[0], row[1]) in wanted:
+                    results[(row[0], n - 1 - row[1])] = row[2] if len(row) > 2 else None
+        return results
+
+    def find_tiles(self, zoom, tiles):
+        return set(self._query(zoom, tiles, ""))
+
+    def get_tiles(self, zoom, tiles):
+        return self._query(zoom, tiles, ", tile_data")
+
+    def get_tile(self, zoom, tile_x, tile_y):
+        return self.get_tiles(zoom, [(tile_x, tile_y)]).get((tile_x, tile_y))
+
+
+def _read_varint(buffer, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _zxy_to_tile_id(zoom, tile_x, tile_y):
+    # position on hilbert curve, preceded by all tiles of lower zoom levels
+    tile_id = ((1 << (zoom * 2)) - 1) // 3
+    a = zoom - 1
+    while a >= 0:
+        s = 1 << a
+        rx = s & tile_x
+        ry = s & tile_y
+        tile_id += ((3 * rx) ^ ry) << a
+        if ry == 0:
+            if rx != 0:
+                tile_x = s - 1 - tile_x
+                tile_y = s - 1 - tile_y
+            tile_x, tile_y = tile_y, tile_x
+        a -= 1
+    return tile_id
+
+
+class PMTilesSource:
+    """Raster tiles from a PMTiles (v3) archive"""
+
+    header_size = 127
+    # merge tile reads if the gap between them is smaller than this (bytes)
+    max_read_gap = 64 * 1024
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise ValueError("tile archive does not exist: " + filename)
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.lock = threading.Lock()
+
+        header = self._read(0, PMTilesSource.header_size)
+        if header[0:7] != b"PMTiles" or header[7] != 3:
+            raise ValueError("unsupported PMTiles version in " + filename)
+        (self.root_offset, self.root_length, _, _, self.leaf_offset, _,
+         self.data_offset, _) = struct.unpack_from("<8Q", header, 8)
+        self.internal_compression = header[97]
+        self.tile_compression = header[98]
+        if header[99] not in (2, 3, 4):
+            raise ValueError("unsupported tile type in " + filename + " (only png, jpeg and webp)")
+        if self.internal_compression not in (1, 2) or self.tile_compression not in (0, 1, 2):
+            raise ValueError("unsupported compression in " + filename + " (only none and gzip)")
+
+        self.root = self._read_directory(self.root_offset, self.root_length)
+        self.leaves = {}
+
+    def _read(self, offset, length):
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def _read_directory(self, offset, length):
+        buffer = self._read(offset, length)
+        if self.internal_compression == 2:
+            buffer = gzip.decompress(buffer)
+        num_entries, pos = _read_varint(buffer, 0)
+        tile_ids = []
+        last_id = 0
+        for i in range(num_entries):
+            value, pos = _read_varint(buffer, pos)
+            last_id += value
+            tile_ids.append(last_id)
+        run_lengths = []
+        for i in range(num_entries):
+            value, pos = _read_varint(buffer, pos)
+            run_lengths.append(value)
+        lengths = []
+        for i in range(num_entries):
+            value, pos = _read_varint(buffer, pos)
+            lengths.append(value)
+        offsets = []
+        for i in range(num_entries):
+            value, pos = _read_varint(buffer, pos)
+            if value == 0 and i > 0:
+                offsets.append(offsets[i - 1] + lengths[i - 1])
+            else:
+                offsets.append(value - 1)
+        return (tile_ids, run_lengths, offsets, lengths)
+
+    def _find_entry(self, directory, tile_id):
+        # binary search for last entry with id <= tile_id
+        tile_ids, run_lengths, offsets, lengths = directory
+        lo, hi = 0, len(tile_ids) - 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if tile_ids[mid] <= tile_id:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        if hi < 0:
+            return None
+        if run_lengths[hi] == 0:
+            # leaf directory
+            return (None, offsets[hi], lengths[hi])
+        if tile_id < tile_ids[hi] + run_lengths[hi]:
+            return (tile_ids[hi], offsets[hi], lengths[hi])
+        return None
+
+    def _locate(self, tile_id):
+        directory = self.root
+        for depth in range(4):
+            entry = self._find_entry(directory, tile_id)
+            if entry is None:
+                return None
+            if entry[0] is not None:
+                return (entry[1], entry[2])
+            leaf_key = (entry[1], entry[2])
+            if leaf_key not in self.leaves:
+                self.leaves[leaf_key] = self._read_directory(self.leaf_offset + entry[1], entry[2])
+            directory = self.leaves[leaf_key]
+        return None
+
+    def _locate_tiles(self, zoom, tiles):
+        locations = {}
+        for (tile_x, tile_y) in tiles:
+            location = self._locate(_zxy_to_tile_id(zoom, tile_x, tile_y))
+            if location is not None:
+                locations[(tile_x, tile_y)] = location
+        return locations
+
+    def find_tiles(self, zoom, tiles):
+        return set(self._locate_tiles(zoom, tiles))
+
+    def get_tiles(self, zoom, tiles):
+        # read tile data in as few range reads as possible (tiles sorted by offset, nearby ranges merged)
+        locations = self._locate_tiles(zoom, tiles)
+        ranges = sorted(set(locations.values()))
+        blobs = {}
+        i = 0
+        while i < len(ranges):
+            start = ranges[i][0]
+            end = ranges[i][0] + ranges[i][1]
+            j = i + 1
+            while j < len(ranges) and ranges[j][0] - end < PMTilesSource.max_read_gap:
+                end = max(end, ranges[j][0] + ranges[j][1])
+                j += 1
+            chunk = self._read(self.data_offset + start, end - start)
+            for (offset, length) in ranges[i:j]:
+                data = chunk[offset - start:offset - start + length]
+                if self.tile_compression == 2:
+                    data = gzip.decompress(data)
+                blobs[(offset, length)] = data
+            i = j
+        return {tile: blobs[location] for tile, location in locations.items()}
+
+    def get_tile(self, zoom, tile_x, tile_y):
+        return self.get_tiles(zoom, [(tile_x, tile_y)]).get((tile_x, tile_y))
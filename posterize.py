@@ -1,18 +1,57 @@
 import sys
 import argparse
 import json
+import logging
+import os
 
 # --------------------------------------------------------------------
 # parse command line arguments
 def parse_args():
     # create parser
     parser = argparse.ArgumentParser(description='MapPosterizer')
-    parser.add_argument("-l", "--location", type=argparse.FileType('r'), help="location json file", default="location.json")
-    parser.add_argument("-o", "--output", type=str, help="output png file", default="map.png")
+    parser.add_argument("-l", "--location", type=str, help="location json file", default="location.json")
+    parser.add_argument("-o", "--output", type=str, help="output file (png, tif, jpg, webp or pdf)", default="map.png")
     parser.add_argument("-d", "--dpi", type=int, help="dpi", default=300)
-    parser.add_argument("-c", "--canvas_style", type=argparse.FileType('r'), help="canvas style json file", default="resources/canvas_style_dark.json")
-    parser.add_argument("-m", "--map_style", type=argparse.FileType('r'), help="map style json file", default="resources/map_style_light.json")
+    parser.add_argument("-c", "--canvas_style", type=str, help="canvas style json file", default="resources/canvas_style_dark.json")
+    parser.add_argument("-m", "--map_style", type=str, help="map style json file", default="resources/map_style_light.json")
     parser.add_argument("-s", "--show", help="show generated map", action="store_true")
+    parser.add_argument("-t", "--tiles", type=str, help="local tile archive (.mbtiles or .pmtiles)", default=None)
+    parser.add_argument("--stream", help="render map in bands of tile rows (bounded memory)", action="store_true")
+    parser.add_argument("--band_rows", type=int, help="tile rows per band for --stream", default=4)
+    parser.add_argument("-w", "--workers", type=int, help="number of tile download workers", default=8)
+    parser.add_argument("-g", "--gazetteer", type=str, help="gazetteer file for offline place lookups (csv or geonames txt)", default=None)
+    parser.add_argument("--offline", help="no online place lookups", action="store_true")
+    parser.add_argument("-b", "--batch", type=str, help="batch manifest json file (list of poster jobs)", default=None)
+    parser.add_argument("-p", "--processes", type=int, help="number of render processes for --batch (render threads for --serve)", default=os.cpu_count())
+    parser.add_argument("-f", "--format", type=str, help="output format (png, tiff, jpeg, webp, pdf), default: from output file extension",
+                        choices=("png", "tiff", "jpeg", "webp", "pdf"), default=None)
+    parser.add_argument("--pyramid", type=str, help="tile pyramid of poster for zoomable previews (.dzi file or folder of xyz tiles)", default=None)
+    parser.add_argument("--pyramid_format", type=str, help="format of pyramid tiles", choices=("png", "jpeg", "webp"), default="png")
+    parser.add_argument("--compress_level", type=int, help="png compression level (0-9)", default=6)
+    parser.add_argument("--quality", type=int, help="jpeg/webp/pdf quality (1-100)", default=90)
+    parser.add_argument("--fast", help="fast output encoding (lower compression)", action="store_true")
+    parser.add_argument("-z", "--zoom", type=int, help="zoom level (overrides zoom level of location file)", default=None)
+    parser.add_argument("--cache_styled", help="keep stylized tiles in the tile cache (faster repeated renders)", action="store_true")
+    parser.add_argument("--preview", help="render a low dpi preview from a coarse zoom level (cached tiles are preferred)", action="store_true")
+    parser.add_argument("--refine", help="render previews with increasing zoom level and dpi up to the final poster", action="store_true")
+    parser.add_argument("--preview_dpi", type=int, help="dpi of first preview", default=72)
+    parser.add_argument("--stage_cache_mb", type=int, help="size of cache for rendered maps (MB, 0: no cache, e.g. 1024 for repeated renders)", default=0)
+    parser.add_argument("-q", "--quiet", help="only log warnings and errors", action="store_true")
+    parser.add_argument("--serve", type=str, help="run render server on address (host:port or unix:<socket file>)", default=None)
+    parser.add_argument("--queue_size", type=int, help="max. number of queued jobs for --serve", default=16)
+    parser.add_argument("--seed", type=int, nargs=2, metavar=("MIN_ZOOM", "MAX_ZOOM"),
+                        help="fill tile cache with tiles of the location (or --bbox) for a range of zoom levels", default=None)
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("TOP", "LEFT", "BOTTOM", "RIGHT"),
+                        help="bounding box (lat/lon of top left and bottom right corner) for --seed", default=None)
+    parser.add_argument("--rate", type=float, help="max. tile requests per second for --seed", default=20.0)
+    parser.add_argument("--seed_manifest", type=str, help="manifest file for resuming --seed", default=None)
+    parser.add_argument("--dry_run", help="only print estimates of --seed", action="store_true")
+    parser.add_argument("--plan", help="only estimate tiles, download size, memory and time of the poster", action="store_true")
+    parser.add_argument("--max_tiles", type=int, help="reject posters with more tiles", default=None)
+    parser.add_argument("--max_memory_mb", type=float, help="reject posters with higher estimated memory (MB)", default=None)
+    parser.add_argument("--max_download_mb", type=float, help="reject posters with larger estimated download (MB)", default=None)
+    parser.add_argument("--max_seconds", type=float, help="reject posters with longer estimated render time (s)", default=None)
+    parser.add_argument("--metrics", type=str, help="json file for render metrics (stage timings, tile statistics, memory)", default=None)
 
     # parse command line arguments
     try:
@@ -21,12 +60,11 @@ def parse_args():
         parser.print_usage()
         return None
 
-    # validate resolution and output filename
-    if args.dpi < 50 or args.dpi > 600:
-        print("invalid dpi!")
+    if args.processes is None or args.processes < 1:
+        print("invalid number of processes!")
         return None
-    if args.output is None or args.output == "":
-        print("invalid output filename!")
+    if args.queue_size < 1:
+        print("invalid queue size!")
         return None
 
     return args
@@ -34,57 +72,84 @@ def parse_args():
 # --------------------------------------------------------------------
 # main pipeline
 def main():
-    from map_posterizer import canvas, map
+    from map_posterizer import batch, poster
+    from map_posterizer.metrics import Metrics
 
     # parse command line arguments
     args = parse_args()
     if args is None:
         sys.exit(1)
 
-    # canvas and map styles
-    canvas_style = canvas.CanvasStyle(json.load(args.canvas_style))
-    map_style = map.MapStyle(json.load(args.map_style))
-    if canvas_style is None or map_style is None:
-        print("invalid style files!")
-        sys.exit(3)
+    # log progress messages to stdout
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s", stream=sys.stdout)
 
-    # map location
-    with args.location as location_file:
-        location = map.MapLocation(json.load(location_file))
-    if location is None or location.top_left is None or \
-       location.bottom_right is None or location.zoom is None:
-        print("invalid map location (coordinates and/or zoom)!")
-        sys.exit(2)
-    print(location)
+    # command line values (defaults for all jobs of a batch)
+    config = {option: getattr(args, option) for option in poster.PosterJob.options}
 
-    # create canvas
-    canvas = canvas.Canvas(canvas_style, args.dpi)
-    print(canvas)
-    # create map
-    map = map.Map(map_style, canvas.content_size_mm, args.dpi, location.top_left, location.bottom_right, location.zoom)
-    print(map)
+    if args.seed is not None:
+        # fill tile cache
+        from map_posterizer import seed
+        try:
+            stats = seed.seed_tiles(poster.PosterJob(config), args.seed[0], args.seed[1], args.bbox, args.rate,
+                                    args.seed_manifest, args.dry_run)
+        except poster.PosterError as e:
+            logging.error(e)
+            sys.exit(e.exit_code)
+        except KeyboardInterrupt:
+            sys.exit(4)
+        if stats is not None and stats["failed"] > 0:
+            sys.exit(4)
+        return
 
-    # download all tile images
-    map.download_tiles()
-    # draw map
-    map.draw()
-    # apply image style
-    map.stylize()
-    # draw location marker
-    if not location.marker is None and not location.hide_marker:
-        map.draw_marker(location.marker)
-    # crop image to tl and br region
-    map.crop_to_coords()
+    if args.serve is not None:
+        # render jobs posted to the render server (command line values are the defaults of all jobs)
+        from map_posterizer import server
+        server.serve(args.serve, config, args.processes, args.queue_size)
+        return
 
-    # draw map onto canvas
-    canvas.draw_map(map.get_scaled())
-    # draw text box onto canvas
-    if not location.caption1 == "":
-        canvas.draw_text_box(location.caption1, location.caption2, location.caption3, location.caption4, location.get_marker_coords())
+    if args.batch is not None:
+        # render all posters of batch manifest
+        try:
+            jobs = batch.load_manifest(args.batch, config)
+        except (OSError, ValueError) as e:
+            logging.error("invalid batch manifest! (" + str(e) + ")")
+            sys.exit(1)
+        results = batch.render_batch(jobs, args.processes, args.workers)
+        if args.metrics is not None:
+            with open(args.metrics, "w") as f:
+                json.dump({"jobs": [{key: result[key] for key in ("output", "ok", "error", "time", "metrics")} for result in results]}, f, indent=4)
+        if not all(result["ok"] for result in results):
+            sys.exit(6)
+        return
 
-    # save output canvas
-    canvas.save(args.output, show=args.show)
-    print("poster map saved to " + args.output)
+    if args.plan:
+        # estimate costs of poster (rejected if it exceeds a budget)
+        from map_posterizer import planner
+        try:
+            job = poster.PosterJob(config)
+            job.validate()
+            plan = planner.plan_poster(job)
+        except poster.PosterError as e:
+            logging.error(e)
+            sys.exit(e.exit_code)
+        planner.log_plan(plan)
+        if args.metrics is not None:
+            with open(args.metrics, "w") as f:
+                json.dump(plan, f, indent=4)
+        if plan["budget_errors"]:
+            sys.exit(10)
+        return
+
+    # render poster
+    metrics = Metrics()
+    try:
+        poster.render_poster(poster.PosterJob(config), metrics=metrics)
+    except poster.PosterError as e:
+        logging.error(e)
+        sys.exit(e.exit_code)
+    finally:
+        if args.metrics is not None:
+            metrics.save(args.metrics)
 
 # --------------------------------------------------------------------
 # main function